@@ -0,0 +1,277 @@
+"""Latency, memory and payload benchmark for the dashboard callbacks.
+
+Every callback in main.py is called directly on deterministic synthetic datasets of increasing size, and the
+latency percentiles, peak memory and serialized response size of each one are written to a JSON file, together
+with the bytes of every output id at full and at rounded rate precision, uncompressed and compressed:
+
+    python benchmark.py --output benchmark_results.json
+
+The dataset can be scaled in the number of countries, years and age bands. Years stay whole numbers, as the
+dataset and the year slider key on integer years, so a finer granularity is modelled as more years.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+import pandas as pd
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# dataset sizes: (countries, years, age bands); the Census dataset has about 228 countries, 54 years and 6 bands
+SCALES = {
+    "base": (228, 54, 6),
+    "countries_10x": (2280, 54, 6),
+    "years_4x": (228, 216, 6),
+    "ages_2x": (228, 54, 12),
+}
+
+AGES = ['15-19', '20-24', '25-29', '30-34', '35-39', '40-44']
+
+
+# ----------------------------------------------SYNTHETIC DATA----------------------------------------------------
+
+def synthetic_dataset(countries, years, ages, seed=0):
+    """Return a cleaned long table like the one main.py loads, with made-up but plausible fertility rates.
+
+    The six age groups of the dashboard come first, further bands continue in steps of five years. Every country
+    starts reporting in a random year, so the data has gaps like the Census data. The first country is Germany,
+    the default selection of the dashboard.
+    """
+    rng = np.random.default_rng(seed)
+    names = ["Germany"] + [f"Country {i:05d}" for i in range(1, countries)]
+    codes = ["GM"] + [f"C{i:05d}" for i in range(1, countries)]
+    labels = AGES + [f"{15 + 5 * i}-{19 + 5 * i}" for i in range(len(AGES), ages)]
+    year_range = np.arange(2024 - years, 2024, dtype=np.int16)
+
+    # level per country and age group, a linear trend per country and noise per year
+    level = rng.uniform(5, 250, size=(1, ages, countries))
+    trend = rng.uniform(-0.02, 0.005, size=(1, 1, countries))
+    noise = rng.normal(1, 0.03, size=(years, ages, countries))
+    elapsed = np.arange(years).reshape(-1, 1, 1)
+    rates = np.clip(level * (1 + trend * elapsed) * noise, 0, None).astype(np.float32)
+
+    # countries only have data from their first year of record on
+    first_year = rng.integers(0, years // 3 + 1, size=countries)
+    has_data = elapsed[:, :, 0] >= first_year
+
+    y, c = np.nonzero(has_data)
+    y = np.repeat(y, ages)
+    c = np.repeat(c, ages)
+    a = np.tile(np.arange(ages), len(y) // ages)
+    return pd.DataFrame({
+        "country_code": pd.Categorical.from_codes(c, codes),
+        "country_name": pd.Categorical.from_codes(c, names),
+        "year": year_range[y],
+        "age": pd.Categorical.from_codes(a, labels),
+        "rate": rates[y, a, c],
+    })
+
+
+def write_source_csv(dataframe, path):
+    """Write a long table as a CSV in the wide layout of the Census dataset."""
+    wide = dataframe.pivot_table(index=["country_code", "country_name", "year"], columns="age", values="rate",
+                                 observed=True)
+    wide.columns = ["fertility_rate_" + str(age).replace("-", "_") for age in wide.columns]
+    wide["fertility_rate_45_49"] = np.nan
+    wide.reset_index().to_csv(path, index=False)
+
+
+# -------------------------------------------------BENCHMARK------------------------------------------------------
+
+def callback(main, output_id):
+    """Return the undecorated function of the callback with the given first output."""
+    for outputs, entry in main.app.callback_map.items():
+        if outputs.lstrip(".").startswith(output_id + "."):
+            return entry["callback"].__wrapped__
+    raise KeyError(output_id)
+
+
+def scenarios(main, store, rng, calls):
+    """Return (name, function, argument lists) for every callback, with inputs drawn from ``store``."""
+    years = [int(year) for year in rng.choice(store.years, calls)]
+    marks = main.current_dataset().options["year_marks"]
+    ages = [str(age) for age in rng.choice(AGES, calls)]
+    countries = [str(country) for country in rng.choice(store.countries, calls)]
+    clicks = [{"points": [{"customdata": [country]}]} for country in countries]
+    selections = [[str(country) for country in rng.choice(store.countries, 5, replace=False)] for _ in range(calls)]
+    large_selections = [[str(country) for country in rng.choice(store.countries, 100, replace=False)]
+                        for _ in range(calls)]
+
+    return [
+        ("overview", callback(main, "container_1_text"), [(year, age, marks) for year, age in zip(years, ages)]),
+        ("overview_patch", main.overview_patches, list(zip(years, ages))),
+        ("selection", callback(main, "selected_country"), [(click,) for click in clicks]),
+        ("deep_dive", callback(main, "headline_rates_development"), [(country,) for country in countries]),
+        ("comparison", callback(main, "line_chart_country_comparison"), list(zip(ages, selections))),
+        ("comparison_100", callback(main, "line_chart_country_comparison"), list(zip(ages, large_selections))),
+        ("deviation", callback(main, "headline_deviation"), list(zip(ages, countries))),
+        ("playback", callback(main, "playback_frames"), [(1, age) for age in ages]),
+    ]
+
+
+def callback_outputs(main, output_id):
+    """Return the outputs ("id.property") of the callback with the given first output."""
+    for outputs in main.app.callback_map:
+        if outputs.lstrip(".").startswith(output_id + "."):
+            return outputs.strip(".").split("...")
+    raise KeyError(output_id)
+
+
+def clear_caches(main):
+    main.figure_cache.clear()
+    main.country_cache.clear()
+
+
+def measure(main, function, arguments, cold):
+    """Call ``function`` with every argument list and return its latency, memory and size statistics.
+
+    ``cold`` clears the figure caches before every call; otherwise every input is called once beforehand, so all
+    timed calls are cache hits.
+    """
+    from plotly.io.json import to_json_plotly
+
+    if not cold:
+        for args in arguments:
+            function(*args)
+
+    latencies = []
+    sizes = []
+    for args in arguments:
+        if cold:
+            clear_caches(main)
+        start = time.perf_counter()
+        response = function(*args)
+        latencies.append((time.perf_counter() - start) * 1000)
+        sizes.append(len(to_json_plotly(response).encode()))
+
+    # memory is traced in a separate pass, as tracing slows down the calls
+    peaks = []
+    for args in arguments[:10]:
+        if cold:
+            clear_caches(main)
+        tracemalloc.start()
+        function(*args)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        "calls": len(latencies),
+        "latency_ms": {"mean": float(np.mean(latencies)), "p50": float(np.percentile(latencies, 50)),
+                       "p90": float(np.percentile(latencies, 90)), "p99": float(np.percentile(latencies, 99)),
+                       "max": float(np.max(latencies))},
+        "peak_memory_bytes": int(np.max(peaks)),
+        "response_bytes": {"mean": float(np.mean(sizes)), "max": int(np.max(sizes))},
+    }
+
+
+def payload_sizes(main, store, calls, seed):
+    """Return the mean bytes of every callback output as JSON and compressed, at full and at rounded precision.
+
+    Rates are rounded to main.RATE_DECIMALS decimals; outputs are compressed one by one with gzip (at the level of
+    main.py) and brotli, if installed.
+    """
+    from plotly.io.json import to_json_plotly
+
+    first_outputs = {"overview": "container_1_text", "selection": "selected_country",
+                     "deep_dive": "headline_rates_development", "comparison": "line_chart_country_comparison",
+                     "deviation": "headline_deviation", "playback": "playback_frames"}
+    decimals = main.RATE_DECIMALS
+    sizes = {}
+    for precision, main.RATE_DECIMALS in [("full", -1), ("rounded", decimals)]:
+        clear_caches(main)
+        rng = np.random.default_rng(seed)
+        for name, function, arguments in scenarios(main, store, rng, calls):
+            if name not in first_outputs:
+                continue
+            outputs = callback_outputs(main, first_outputs[name])
+            for args in arguments:
+                response = function(*args)
+                for output, value in zip(outputs, response if len(outputs) > 1 else [response]):
+                    data = to_json_plotly(value).encode()
+                    compressor = zlib.compressobj(main.GZIP_LEVEL, wbits=31)
+                    encoded = {"json": len(data), "gzip": len(compressor.compress(data) + compressor.flush())}
+                    if brotli is not None:
+                        encoded["br"] = len(brotli.compress(data, quality=main.BROTLI_QUALITY))
+                    for encoding, size in encoded.items():
+                        sizes.setdefault(output, {}).setdefault(encoding, {}).setdefault(precision, []).append(size)
+    main.RATE_DECIMALS = decimals
+    clear_caches(main)
+
+    return {output: {encoding: {precision: float(np.mean(values)) for precision, values in by_precision.items()}
+                     for encoding, by_precision in by_encoding.items()}
+            for output, by_encoding in sizes.items()}
+
+
+def run(scales, calls, seed):
+    """Benchmark every callback on every scale and return the results."""
+    with tempfile.TemporaryDirectory() as directory:
+        # main.py loads its dataset at import, so point it at a synthetic one of the base size
+        source = os.path.join(directory, "age_specific_fertility_rates.csv")
+        write_source_csv(synthetic_dataset(*SCALES["base"], seed=seed), source)
+        os.environ["FERTILITY_DATA"] = source
+        os.environ["PATCH_UPDATES"] = "0"
+        os.environ["DATA_RELOAD_INTERVAL"] = "0"
+        os.environ.setdefault("COUNTRY_CACHE_WARMUP", "")
+        import main
+
+        results = {}
+        for name in scales:
+            countries, years, ages = SCALES[name]
+            dataframe = synthetic_dataset(countries, years, ages, seed=seed)
+            start = time.perf_counter()
+            store = main.DataStore(dataframe)
+            build_ms = (time.perf_counter() - start) * 1000
+            main.swap_dataset(main.make_dataset(name, store))
+
+            rng = np.random.default_rng(seed)
+            callbacks = {}
+            for callback_name, function, arguments in scenarios(main, store, rng, calls):
+                callbacks[callback_name] = {"cold": measure(main, function, arguments, cold=True),
+                                            "warm": measure(main, function, arguments, cold=False)}
+                print(f"{name:>14} {callback_name:>15}: "
+                      f"p50 {callbacks[callback_name]['cold']['latency_ms']['p50']:8.2f} ms cold, "
+                      f"{callbacks[callback_name]['warm']['latency_ms']['p50']:8.2f} ms warm", file=sys.stderr)
+
+            payloads = payload_sizes(main, store, min(calls, 10), seed)
+            for output, sizes in payloads.items():
+                smallest = min(size["rounded"] for size in sizes.values())
+                print(f"{name:>14} {output:>38}: {sizes['json']['full']:10.0f} B, {smallest:8.0f} B rounded and "
+                      f"compressed ({1 - smallest / sizes['json']['full']:.0%} saved)", file=sys.stderr)
+
+            results[name] = {"countries": countries, "years": years, "ages": ages, "rows": len(dataframe),
+                             "store_build_ms": build_ms, "callbacks": callbacks, "payloads": payloads,
+                             "rate_decimals": main.RATE_DECIMALS}
+            clear_caches(main)
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard callbacks on synthetic datasets")
+    parser.add_argument("--scale", action="append", choices=sorted(SCALES),
+                        help="dataset size to benchmark, can be repeated (default: all)")
+    parser.add_argument("--calls", type=int, default=50, help="calls per callback and scale (default: 50)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data and inputs (default: 0)")
+    parser.add_argument("--output", default="benchmark_results.json", help="file the results are written to")
+    args = parser.parse_args()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "calls": args.calls,
+        "seed": args.seed,
+        "scales": run(args.scale or list(SCALES), args.calls, args.seed),
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
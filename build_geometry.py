@@ -0,0 +1,163 @@
+"""Build the simplified country outlines drawn on the world map.
+
+The outlines are generated from a Natural Earth admin-0 countries GeoJSON (any scale, e.g.
+``ne_50m_admin_0_countries.geojson`` from https://www.naturalearthdata.com) and written to
+``assets/geometry/countries_<level>.geojson`` for every simplification level:
+
+    python build_geometry.py ne_50m_admin_0_countries.geojson --dataset age_specific_fertility_rates.csv
+
+Every feature is keyed on its ISO-3 code and carries the FIPS 10-4 code used by the Census dataset, so main.py can
+look countries up by code instead of by name. With ``--dataset``, the countries of the dataset without an outline
+are reported.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# simplification levels: (Douglas-Peucker tolerance in degrees, decimals kept of every coordinate)
+LEVELS = {
+    "low": (0.2, 1),
+    "medium": (0.05, 2),
+    "high": (0.01, 3),
+}
+
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "geometry")
+
+
+# ------------------------------------------------SIMPLIFICATION--------------------------------------------------
+
+def douglas_peucker(points, tolerance):
+    """Return a boolean mask of the points of an open line kept by the Douglas-Peucker algorithm."""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        segment = end - start
+        inner = points[first + 1:last] - start
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack += [(first, split), (split, last)]
+    return keep
+
+
+def simplify_ring(ring, tolerance, decimals):
+    """Simplify a closed ring; the result keeps at least three distinct points, so no ring collapses."""
+    points = np.asarray(ring, dtype=np.float64)[:-1]
+    if len(points) < 4:
+        return np.round(ring, decimals).tolist()
+
+    # split the ring at the point farthest from its start and simplify both halves
+    split = int(np.argmax(np.hypot(*(points - points[0]).T)))
+    closed = np.vstack([points, points[:1]])
+    keep = np.concatenate([douglas_peucker(closed[:split + 1], tolerance)[:-1],
+                           douglas_peucker(closed[split:], tolerance)])
+    simplified = np.round(closed[keep], decimals)
+
+    # rounding can repeat points
+    distinct = np.concatenate([[True], np.any(np.diff(simplified, axis=0) != 0, axis=1)])
+    simplified = simplified[distinct]
+    if len(simplified) < 4:
+        simplified = np.round(closed[np.linspace(0, len(closed) - 1, 4).astype(int)], decimals)
+    return simplified.tolist()
+
+
+def ring_area(ring):
+    x, y = np.asarray(ring, dtype=np.float64).T
+    return abs(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])) / 2
+
+
+def simplify_geometry(geometry, tolerance, decimals):
+    """Simplify a (Multi)Polygon; holes and islands smaller than the tolerance are dropped."""
+    polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+    minimum = tolerance ** 2
+
+    simplified = []
+    for polygon in polygons:
+        if ring_area(polygon[0]) < minimum:
+            continue
+        simplified.append([simplify_ring(ring, tolerance, decimals) for ring in polygon
+                           if ring is polygon[0] or ring_area(ring) >= minimum])
+
+    # a country made of small islands only keeps its largest one
+    if not simplified:
+        largest = max(polygons, key=lambda polygon: ring_area(polygon[0]))
+        simplified = [[simplify_ring(largest[0], tolerance, decimals)]]
+
+    if len(simplified) == 1:
+        return {"type": "Polygon", "coordinates": simplified[0]}
+    return {"type": "MultiPolygon", "coordinates": simplified}
+
+
+# ---------------------------------------------------BUILD--------------------------------------------------------
+
+def country_codes(properties):
+    """Return the (ISO-3, FIPS 10-4) codes of a Natural Earth feature; None where it has none."""
+    iso = properties.get("ISO_A3")
+    if iso in (None, "-99"):
+        iso = properties.get("ADM0_A3")
+    fips = properties.get("FIPS_10", properties.get("FIPS_10_"))
+    return (iso if iso not in (None, "-99") else None), (fips if fips not in (None, "-99") else None)
+
+
+def build(source, tolerance, decimals):
+    """Return a GeoJSON FeatureCollection of the simplified outlines of all countries in ``source``."""
+    with open(source) as file:
+        features = json.load(file)["features"]
+
+    outlines = []
+    for feature in features:
+        iso, fips = country_codes(feature["properties"])
+        if iso is None or feature["geometry"] is None:
+            continue
+        outlines.append({
+            "type": "Feature",
+            "id": iso,
+            "properties": {"name": feature["properties"].get("NAME"), "fips": fips},
+            "geometry": simplify_geometry(feature["geometry"], tolerance, decimals),
+        })
+    return {"type": "FeatureCollection", "features": outlines}
+
+
+def unmatched_countries(collection, dataset):
+    """Return the (code, name) pairs of the countries in the dataset CSV that have no outline."""
+    codes = {feature["properties"]["fips"] for feature in collection["features"]}
+    countries = pd.read_csv(dataset, usecols=["country_code", "country_name"]).drop_duplicates()
+    return [(code, name) for code, name in countries.itertuples(index=False) if code not in codes]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the simplified country outlines of the world map")
+    parser.add_argument("source", help="Natural Earth admin-0 countries GeoJSON")
+    parser.add_argument("--dataset", help="dataset CSV whose countries without an outline are reported")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR, help="directory the outlines are written to")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for level, (tolerance, decimals) in LEVELS.items():
+        collection = build(args.source, tolerance, decimals)
+        path = os.path.join(args.output_dir, f"countries_{level}.geojson")
+        with open(path, "w") as file:
+            json.dump(collection, file, separators=(",", ":"))
+        print(f"{level:>7}: {len(collection['features'])} countries, {os.path.getsize(path) / 1e3:.0f} kB",
+              file=sys.stderr)
+
+    if args.dataset:
+        unmatched = unmatched_countries(collection, args.dataset)
+        print(f"{len(unmatched)} countries of the dataset have no outline:", file=sys.stderr)
+        for code, name in unmatched:
+            print(f"  {code} {name}", file=sys.stderr)
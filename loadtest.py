@@ -0,0 +1,364 @@
+"""Concurrent load test of the dashboard server.
+
+Simulated sessions replay the interactions of real users as Dash callback requests, the way the browser sends them:
+scrubbing the year slider, clicking countries on the world map (which also updates the deep dive, deviation and
+comparison charts) and building up a multi-country comparison. The callbacks and the values the controls offer are
+read from the server itself (/_dash-dependencies and /_dash-layout), so the scripts follow the layout.
+
+Every worker configuration ``PxT`` starts P server processes on localhost, each handling requests in a pool of T
+threads; sessions are spread over the processes like behind a load balancer. For every configuration and number
+of sessions the throughput, latency percentiles and error rate are written to a JSON file:
+
+    python loadtest.py --workers 1x1 --workers 1x8 --workers 4x1 --sessions 1 --sessions 16 --duration 20
+
+``--in-process`` drives main.server through Flask's test client instead, without sockets, which measures the
+application alone. Only the Python standard library, Flask and Werkzeug are used.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from werkzeug.serving import BaseWSGIServer
+
+# relative frequency of the interaction scripts within a session
+SCRIPTS = {"scrub": 4, "click": 3, "compare": 2}
+
+CALLBACK_PATH = "/_dash-update-component"
+
+
+# -------------------------------------------------SERVER--------------------------------------------------------
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server that handles requests in a fixed pool of threads, like a threaded production worker."""
+
+    def __init__(self, host, port, app, threads):
+        super().__init__(host, port, app)
+        self.pool = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def serve(port, threads):
+    """Serve main.server on ``port`` until the process is terminated."""
+    import main
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    PooledWSGIServer("127.0.0.1", port, main.server, threads).serve_forever()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_servers(processes, threads, timeout=120):
+    """Start ``processes`` server processes and return them with their ports once all of them answer."""
+    ports = [free_port() for _ in range(processes)]
+    servers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port), str(threads)])
+               for port in ports]
+    deadline = time.monotonic() + timeout
+    for server, port in zip(servers, ports):
+        while True:
+            if server.poll() is not None:
+                stop_servers(servers)
+                raise RuntimeError(f"server on port {port} exited with status {server.returncode}")
+            try:
+                if HttpClient(port).get("/_dash-layout")[0] == 200:
+                    break
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                stop_servers(servers)
+                raise TimeoutError(f"server on port {port} did not start within {timeout} s")
+            time.sleep(0.2)
+    return servers, ports
+
+
+def stop_servers(servers):
+    for server in servers:
+        server.terminate()
+    for server in servers:
+        server.wait()
+
+
+# -------------------------------------------------CLIENTS-------------------------------------------------------
+
+class HttpClient:
+    """Client of one server process; every request uses a new connection, like a browser behind a proxy."""
+
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, body=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        try:
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def get(self, path):
+        return self.request("GET", path)
+
+    def post(self, path, payload):
+        return self.request("POST", path, json.dumps(payload))
+
+
+class InProcessClient:
+    """Client calling main.server through Flask's test client."""
+
+    def __init__(self, server):
+        self.client = server.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.data
+
+    def post(self, path, payload):
+        response = self.client.post(path, json=payload)
+        return response.status_code, response.data
+
+
+# ------------------------------------------------SCRIPTS--------------------------------------------------------
+
+def find_components(node, found=None):
+    """Return the props of all components with an id in a /_dash-layout tree, by id."""
+    found = {} if found is None else found
+    if isinstance(node, dict):
+        props = node.get("props", {})
+        if isinstance(props.get("id"), str):
+            found[props["id"]] = props
+        for value in props.values():
+            find_components(value, found)
+    elif isinstance(node, list):
+        for item in node:
+            find_components(item, found)
+    return found
+
+
+class Dashboard:
+    """The callbacks of the dashboard and the values its controls offer, as served to the browser."""
+
+    def __init__(self, client):
+        status, body = client.get("/_dash-dependencies")
+        self.callbacks = {}
+        for dependency in json.loads(body):
+            if dependency.get("clientside_function"):
+                continue
+            for output in dependency["output"].strip(".").split("..."):
+                self.callbacks.setdefault(output.split(".")[0], dependency)
+
+        status, body = client.get("/_dash-layout")
+        components = find_components(json.loads(body))
+        slider = components["year_slider"]
+        self.marks = slider["marks"]
+        self.years = [int(year) for year in slider["marks"] if slider["min"] <= int(year) <= slider["max"]]
+        self.ages = [option["value"] for option in components["age_buttons"]["options"]]
+        self.countries = [option["value"] for option in components["dropdown_countries"]["options"]]
+
+    def payload(self, output_id, values, changed):
+        """Return the request the browser sends for the callback of ``output_id`` with the given input values."""
+        dependency = self.callbacks[output_id]
+
+        def props(dependencies):
+            return [{"id": item["id"], "property": item["property"],
+                     "value": values.get(f"{item['id']}.{item['property']}")} for item in dependencies]
+
+        return {"output": dependency["output"], "inputs": props(dependency["inputs"]),
+                "state": props(dependency["state"]), "changedPropIds": [changed]}
+
+
+def scrub(dashboard, rng):
+    """Drag the year slider across a few consecutive years of one age group."""
+    values = {"age_buttons.value": str(rng.choice(dashboard.ages)), "year_slider.marks": dashboard.marks}
+    start = int(rng.integers(len(dashboard.years)))
+    for year in dashboard.years[start:start + int(rng.integers(3, 9))]:
+        values["year_slider.value"] = year
+        yield "overview", dashboard.payload("container_1_text", dict(values), "year_slider.value")
+
+
+def click(dashboard, rng):
+    """Click a country on the world map; the selection then updates the charts that depend on it."""
+    country = str(rng.choice(dashboard.countries))
+    age = str(rng.choice(dashboard.ages))
+    values = {"world_map.clickData": {"points": [{"customdata": [country]}]}, "selected_country.data": country,
+              "dropdown_countries.value": [country], "dropdown_age_1.value": age, "dropdown_age_2.value": age}
+    yield "selection", dashboard.payload("selected_country", values, "world_map.clickData")
+    yield "deep_dive", dashboard.payload("headline_rates_development", values, "selected_country.data")
+    yield "deviation", dashboard.payload("headline_deviation", values, "selected_country.data")
+    yield "comparison", dashboard.payload("line_chart_country_comparison", values, "dropdown_countries.value")
+
+
+def compare(dashboard, rng):
+    """Add countries to the comparison one by one."""
+    countries = [str(country) for country in rng.choice(dashboard.countries, int(rng.integers(2, 31)))]
+    values = {"dropdown_age_1.value": str(rng.choice(dashboard.ages))}
+    for count in range(1, len(countries) + 1):
+        values["dropdown_countries.value"] = countries[:count]
+        yield "comparison", dashboard.payload("line_chart_country_comparison", dict(values),
+                                              "dropdown_countries.value")
+
+
+# -------------------------------------------------LOAD TEST-----------------------------------------------------
+
+def session(client, dashboard, seed, deadline, think_ms):
+    """Replay randomly chosen scripts until ``deadline``; return (interaction, latency in s, status) per request."""
+    rng = np.random.default_rng(seed)
+    names = list(SCRIPTS)
+    weights = np.array([SCRIPTS[name] for name in names], dtype=float)
+    script_functions = {"scrub": scrub, "click": click, "compare": compare}
+    records = []
+    while time.monotonic() < deadline:
+        for interaction, payload in script_functions[rng.choice(names, p=weights / weights.sum())](dashboard, rng):
+            if time.monotonic() >= deadline:
+                break
+            start = time.perf_counter()
+            try:
+                status = client.post(CALLBACK_PATH, payload)[0]
+            except OSError:
+                status = 0
+            records.append((interaction, time.perf_counter() - start, status))
+            if think_ms:
+                time.sleep(think_ms / 1000)
+    return records
+
+
+def summarize(records, wall):
+    """Return throughput, error rate and latency percentiles of a list of request records."""
+    def latency(values):
+        values = np.array(values) * 1000
+        return {"mean": float(values.mean()), "p50": float(np.percentile(values, 50)),
+                "p90": float(np.percentile(values, 90)), "p99": float(np.percentile(values, 99)),
+                "max": float(values.max())}
+
+    # Dash answers 204 when a callback prevents its update
+    errors = sum(1 for _, _, status in records if status not in (200, 204))
+    result = {"requests": len(records), "errors": errors, "error_rate": errors / max(len(records), 1),
+              "throughput_rps": len(records) / wall}
+    if records:
+        result["latency_ms"] = latency([seconds for _, seconds, _ in records])
+        result["interactions"] = {
+            name: {"requests": len(values), "latency_ms": latency(values)}
+            for name in sorted({record[0] for record in records})
+            for values in [[seconds for interaction, seconds, _ in records if interaction == name]]}
+    return result
+
+
+def drive(clients, sessions, duration, think_ms, seed):
+    """Run ``sessions`` concurrent sessions, spread over ``clients``, for ``duration`` seconds."""
+    dashboard = Dashboard(clients[0])
+    deadline = time.monotonic() + duration
+    start, cpu = time.perf_counter(), time.process_time()
+    with ThreadPoolExecutor(sessions) as pool:
+        futures = [pool.submit(session, clients[i % len(clients)], dashboard, seed + i, deadline, think_ms)
+                   for i in range(sessions)]
+        records = [record for future in futures for record in future.result()]
+    wall = time.perf_counter() - start
+
+    # a load generator that is busy most of the time limits the load itself, so the results understate the server
+    return {**summarize(records, wall), "client_cpu_share": (time.process_time() - cpu) / wall}
+
+
+def run(workers, session_counts, duration, think_ms, seed, in_process):
+    """Load-test every worker configuration with every number of sessions and return the results."""
+    results = {}
+    if in_process:
+        import main
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        configurations = {"in-process": None}
+    else:
+        configurations = {config: tuple(int(n) for n in config.split("x")) for config in workers}
+
+    for name, shape in configurations.items():
+        servers, ports = start_servers(*shape) if shape else ([], [])
+        try:
+            results[name] = {}
+            for sessions in session_counts:
+                # one client per session, so sessions are spread evenly over the server processes
+                clients = [HttpClient(ports[i % len(ports)]) if ports else InProcessClient(main.server)
+                           for i in range(sessions)]
+                # a short warm-up, so that lazily built templates and caches are not part of the measurement
+                drive(clients, sessions, min(duration, 2), 0, seed + sessions)
+                results[name][sessions] = drive(clients, sessions, duration, think_ms, seed)
+                summary = results[name][sessions]
+                print(f"{name:>10} {sessions:4d} sessions: {summary['throughput_rps']:8.1f} req/s, "
+                      f"p50 {summary.get('latency_ms', {}).get('p50', 0):8.2f} ms, "
+                      f"p99 {summary.get('latency_ms', {}).get('p99', 0):8.2f} ms, "
+                      f"errors {summary['error_rate']:.1%}, client CPU {summary['client_cpu_share']:.0%}",
+                      file=sys.stderr)
+        finally:
+            stop_servers(servers)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the dashboard with concurrent simulated sessions")
+    parser.add_argument("--workers", action="append",
+                        help="server configuration PxT: P processes with T threads each, can be repeated "
+                             "(default: 1x1, 1x8 and 4x1)")
+    parser.add_argument("--sessions", action="append", type=int,
+                        help="number of concurrent sessions, can be repeated (default: 1, 8 and 32)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per measurement (default: 10)")
+    parser.add_argument("--think-ms", type=float, default=0,
+                        help="pause of every session between two requests (default: 0, i.e. maximum load)")
+    parser.add_argument("--scale", help="run against a synthetic dataset of this benchmark.py scale instead of "
+                                        "the configured dataset")
+    parser.add_argument("--in-process", action="store_true", help="call main.server in this process, no sockets")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the interaction scripts (default: 0)")
+    parser.add_argument("--output", default="loadtest_results.json", help="file the results are written to")
+    parser.add_argument("--serve", nargs=2, type=int, metavar=("PORT", "THREADS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(*args.serve)
+        sys.exit()
+
+    for config in args.workers or []:
+        if len(config.split("x")) != 2 or not all(part.isdigit() and int(part) > 0 for part in config.split("x")):
+            parser.error(f"invalid worker configuration {config!r}, expected e.g. 4x2")
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.scale:
+            import benchmark
+
+            source = os.path.join(directory, "age_specific_fertility_rates.csv")
+            benchmark.write_source_csv(benchmark.synthetic_dataset(*benchmark.SCALES[args.scale], seed=args.seed),
+                                       source)
+            os.environ["FERTILITY_DATA"] = source
+
+        report = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "scale": args.scale,
+            "duration_s": args.duration,
+            "think_ms": args.think_ms,
+            "seed": args.seed,
+            "results": run(args.workers or ["1x1", "1x8", "4x1"], args.sessions or [1, 8, 32], args.duration,
+                           args.think_ms, args.seed, args.in_process),
+        }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
@@ -1,310 +1,1614 @@
-from dash import Dash, dcc, html, Input, Output
-import plotly.express as px
+from dash import Dash, dcc, html, Input, Output, State, Patch, ctx, no_update
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
+# imported up front (about 10 ms, plotly.io included): it registers clientside callbacks on import, which must not
+# race with Dash setting up the server on the first request while the cache warmup builds the figure templates
 from dash_bootstrap_templates import load_figure_template
 import pandas as pd
+import numpy as np
+import plotly
 import plotly.graph_objects as go
-import colorlover as cl
-
-load_figure_template("spacelab")
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, request
+import argparse
+import hashlib
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import warnings
+import zlib
+from urllib.parse import parse_qs, urlsplit
+
+# plotly.express and colorlover are only imported when the figure templates are built
+
+
+class StartupProfile:
+    """Wall time of the startup phases, each measured from the end of the previous one.
+
+    The first phase, the interpreter start and the imports above, is measured as the CPU time of the process.
+    """
+
+    def __init__(self, first_phase):
+        self.phases = [(first_phase, time.process_time() * 1000)]
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self.last) * 1000))
+        self.last = now
+
+    def report(self):
+        width = max(len(phase) for phase, _ in self.phases)
+        lines = [f"{phase:<{width}}  {ms:8.1f} ms" for phase, ms in self.phases]
+        return "\n".join(lines + [f"{'total':<{width}}  {sum(ms for _, ms in self.phases):8.1f} ms"])
+
+
+startup = StartupProfile("interpreter and imports")
 
 app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP],
            meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1"}
                       ])
+startup.mark("app")
+# ------------------------------------------------CONFIGURATION----------------------------------------------------
+
+# location of the dataset and of the preprocessed columnar copy that is loaded instead of the CSV
+DATA_PATH = os.environ.get("FERTILITY_DATA", '/Filepath/age_specific_fertility_rates.csv')
+DATA_CACHE_DIR = os.environ.get("FERTILITY_CACHE_DIR", os.path.splitext(DATA_PATH)[0] + "_cache")
+
+# memory-map the data store from the dataset cache, so all workers on a host share one read-only copy
+SHARED_STORE = os.environ.get("SHARED_STORE", "1") == "1"
+
+# JSON file describing further Census datasets served next to the fertility rates (see read_data_sources), and
+# the memory all loaded datasets of a process may take before the least recently used ones are unloaded
+DATA_SOURCES = os.environ.get("DATA_SOURCES", "")
+DATASET_MEMORY_MB = float(os.environ.get("DATASET_MEMORY_MB", 1024))
+
+# seconds between two checks of the dataset for changes, which are then loaded without a restart; 0 disables them
+DATA_RELOAD_INTERVAL = float(os.environ.get("DATA_RELOAD_INTERVAL", 60))
+
+# serve the figures rendered ahead of time with --precompute from the dataset cache, rendering only the missing ones
+PRECOMPUTED_FIGURES = os.environ.get("PRECOMPUTED_FIGURES", "1") == "1"
+
+# decimals of the fertility rates sent to the charts, which shortens their JSON; -1 sends them at full precision
+RATE_DECIMALS = int(os.environ.get("RATE_DECIMALS", 2))
+
+# number of (year, age) figure sets, and of the patches that update the figures to them, kept in memory;
+# FIGURE_CACHE_WARMUP=1 renders all of them at startup
+FIGURE_CACHE_SIZE = int(os.environ.get("FIGURE_CACHE_SIZE", 512))
+FIGURE_CACHE_WARMUP = os.environ.get("FIGURE_CACHE_WARMUP", "0") == "1"
+
+# number of countries whose deep-dive figures are kept in memory, and the countries rendered at startup
+COUNTRY_CACHE_SIZE = int(os.environ.get("COUNTRY_CACHE_SIZE", 256))
+COUNTRY_CACHE_WARMUP = [country.strip() for country in os.environ.get("COUNTRY_CACHE_WARMUP", "Germany").split(",")
+                        if country.strip()]
+
+# simplification level of the country outlines drawn on the world map (low, medium or high), see build_geometry.py
+MAP_GEOMETRY = os.environ.get("MAP_GEOMETRY", "medium")
+
+# number of countries in the highest / lowest fertility rate charts
+RANKING_SIZE = int(os.environ.get("RANKING_SIZE", 10))
+
+# number of countries from which the comparison chart is drawn with WebGL, and the maximum number of points per
+# country in it (longer series are downsampled; 0 keeps all points)
+COMPARISON_WEBGL_THRESHOLD = int(os.environ.get("COMPARISON_WEBGL_THRESHOLD", 20))
+COMPARISON_MAX_POINTS = int(os.environ.get("COMPARISON_MAX_POINTS", 0))
+
+# responses of at least this many bytes are compressed with brotli (if installed) or gzip, as the client accepts;
+# 0 disables compression
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+
+# number of overview and deep-dive callback responses kept encoded and compressed, to be sent again as they are
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 256))
+
+# record the timings and response sizes of all callbacks, served in Prometheus format at /metrics; the response
+# of every METRICS_PAYLOAD_SAMPLE-th request is also broken down by output
+CALLBACK_METRICS = os.environ.get("CALLBACK_METRICS", "1") == "1"
+METRICS_PAYLOAD_SAMPLE = int(os.environ.get("METRICS_PAYLOAD_SAMPLE", 20))
+
+# time between two years in the year playback, in milliseconds
+PLAYBACK_INTERVAL_MS = int(os.environ.get("PLAYBACK_INTERVAL_MS", 800))
+
+# after the first render, send only the changed data arrays of the world map and bar charts
+PATCH_UPDATES = os.environ.get("PATCH_UPDATES", "1") == "1"
+
 # ----------------------------------------------DATA PREPARATION---------------------------------------------------
 
+# Every dataset is described by a DataSource: its CSV, the columns identifying a row (keyed by the country_code,
+# country_name and year columns they become), the measure columns with the age group each one stands for, and the
+# range of years that is kept. The wide CSV is unpivoted into a long table with one row per country, year and age.
+# The remaining fields word the page for the dataset and fix the axis ranges of the rankings and the deviation chart.
+
+DataSource = namedtuple("DataSource", ["id", "title", "description", "path", "cache_dir", "id_columns", "measures",
+                                       "years", "panel_title", "default_country", "rate_label", "unit", "event",
+                                       "rate_range", "deviation_range"])
+
+DATA_COLUMNS = ['country_code', 'country_name', 'year', 'age', 'rate']
+
 # source: https://www.kaggle.com/datasets/census/international-data?select=age_specific_fertility_rates.csv
+FERTILITY = DataSource(
+    id="fertility",
+    title="Fertility Rate Analysis",
+    description="The Fertility Rate represents the number of births in a population per 1,000 women of reproductive "
+                "age in a given year. Over the past 50 years, fertility rates have experienced a steady global "
+                "decline. This trend can be attributed to several factors, including the postponement of family "
+                "formation and childbearing, as well as a decrease in the desired size of families. This dashboard "
+                "visualizes the change in fertility rates for different age groups since 1970.",
+    path=DATA_PATH,
+    cache_dir=DATA_CACHE_DIR,
+    id_columns={"country_code": "country_code", "country_name": "country_name", "year": "year"},
+    measures={f"fertility_rate_{age.replace('-', '_')}": age
+              for age in ['15-19', '20-24', '25-29', '30-34', '35-39', '40-44']},
+    years=(1970, 2023),
+    panel_title="Fertility rate among women aged <b>{age}</b> years",
+    default_country="Germany",
+    rate_label="Fertility Rate",
+    unit="out of 1000 women",
+    event="gave birth",
+    rate_range=[0, 350],
+    deviation_range=[-300, 300],
+)
 
-# open dataset
-df = pd.read_csv('/Filepath/age_specific_fertility_rates.csv', sep=',', header=0,
-                 usecols=lambda x: x != '')
-
-# unpivot DataFrame from wide format to long format
-df = pd.melt(df, id_vars=['country_code', 'country_name', 'year'], value_vars=['fertility_rate_15_19',
-                                                                               'fertility_rate_20_24',
-                                                                               'fertility_rate_25_29',
-                                                                               'fertility_rate_30_34',
-                                                                               'fertility_rate_35_39',
-                                                                               'fertility_rate_40_44',
-                                                                               'fertility_rate_45_49'],
-             var_name='age', value_name='rate')
-
-# delete unnecessary data
-df = df.drop(df[df.year > 2023].index)
-df = df.drop(df[df.year < 1970].index)
-df = df.drop(df[df.age == 'fertility_rate_45_49'].index)
-df = df.replace('fertility_rate_15_19', '15-19')
-df = df.replace('fertility_rate_20_24', '20-24')
-df = df.replace('fertility_rate_25_29', '25-29')
-df = df.replace('fertility_rate_30_34', '30-34')
-df = df.replace('fertility_rate_35_39', '35-39')
-df = df.replace('fertility_rate_40_44', '40-44')
-
-df["rate"] = df["rate"].astype(float)
+
+def read_data_sources(path):
+    """Return the data sources described in the JSON file at ``path``, a list of objects with DataSource fields.
+
+    ``description`` is optional, ``cache_dir`` defaults to the CSV path without extension plus ``_cache``,
+    ``id_columns`` to the column names of the Census datasets, ``years`` to all years, ``panel_title`` to the age
+    group, ``default_country`` to the first country by name, ``rate_label`` to "Rate", ``unit`` and ``event`` to
+    empty texts and the axis ranges to None, which scales the axes to the data.
+    """
+    with open(path) as file:
+        entries = json.load(file)
+    return [DataSource(**{"description": "", "cache_dir": os.path.splitext(entry["path"])[0] + "_cache",
+                          "id_columns": FERTILITY.id_columns, "years": None, "panel_title": "<b>{age}</b>",
+                          "default_country": None, "rate_label": "Rate", "unit": "", "event": "",
+                          "rate_range": None, "deviation_range": None, **entry})
+            for entry in entries]
+
+
+# storage types of the numeric columns; all other columns are stored as categoricals
+COMPACT_DTYPES = {'year': np.int16, 'rate': np.float32}
+
+
+def prepare_dataset(source):
+    """Read the CSV of a data source from the Census Bureau and return the cleaned long table."""
+    # open dataset
+    df = pd.read_csv(source.path, sep=',', header=0,
+                     usecols=list(source.id_columns.values()) + list(source.measures))
+    df = df.rename(columns={column: name for name, column in source.id_columns.items()})
+
+    # unpivot DataFrame from wide format to long format
+    df = pd.melt(df, id_vars=['country_code', 'country_name', 'year'], value_vars=list(source.measures),
+                 var_name='age', value_name='rate')
+    df["age"] = df["age"].map(source.measures)
+    df["rate"] = df["rate"].astype(float)
+
+    # delete unnecessary data
+    if source.years:
+        df = df[(df.year >= source.years[0]) & (df.year <= source.years[1])]
+
+    return df[DATA_COLUMNS].reset_index(drop=True)
+
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of a file, read in 1 MiB chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """Open a temporary file next to ``path`` for writing and move it to ``path`` when the block completes.
+
+    Readers see either the previous file or the complete new one; the temporary file is removed if the block fails.
+    """
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary, mode) as file:
+            yield file
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def remove_versions(directory, keep):
+    """Remove the subdirectories of ``directory`` named by a dataset version, except the versions in ``keep``.
+
+    Files left there by caches written before versions had directories of their own are removed as well.
+    """
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name in keep:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+def dataset_cache_dir(cache_dir, version):
+    return os.path.join(cache_dir, "data", version)
+
+
+def write_dataset_cache(dataframe, cache_dir, source):
+    """Write the cleaned long table to ``cache_dir`` as one .npy file per column.
+
+    String columns are stored as int32 codes with their labels in ``columns.json``, years as int16 and rates as
+    float32. Every version of the data is written to a directory of its own; ``meta.json``, which records the
+    mtime, size and hash of the ``source`` CSV and thereby the current version, is replaced last, so readers
+    never see a half-written cache. The directories of versions older than the previous one are removed.
+    """
+    stat = os.stat(source)
+    meta = {"source": os.path.abspath(source), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+            "sha256": file_digest(source)}
+    version = meta["sha256"][:12]
+    directory = dataset_cache_dir(cache_dir, version)
+    os.makedirs(directory, exist_ok=True)
+
+    columns = {"rows": len(dataframe), "categories": {}}
+    for column in dataframe.columns:
+        values = dataframe[column]
+        if column in COMPACT_DTYPES:
+            values = values.to_numpy(dtype=COMPACT_DTYPES[column])
+        else:
+            codes, labels = pd.factorize(values)
+            values = codes.astype(np.int32)
+            columns["categories"][column] = labels.tolist()
+        with atomic_write(os.path.join(directory, column + ".npy")) as file:
+            np.save(file, values)
+    with atomic_write(os.path.join(directory, "columns.json"), 'w') as file:
+        json.dump(columns, file)
+
+    try:
+        previous = dataset_version(cache_dir)
+    except (OSError, ValueError, KeyError):
+        previous = None
+    with atomic_write(os.path.join(cache_dir, "meta.json"), 'w') as file:
+        json.dump(meta, file)
+    for name in ("data", "store"):
+        remove_versions(os.path.join(cache_dir, name), {version, previous})
+    # column files of caches written before versions had directories of their own
+    for column in DATA_COLUMNS:
+        if os.path.exists(os.path.join(cache_dir, column + ".npy")):
+            os.remove(os.path.join(cache_dir, column + ".npy"))
+
+
+def read_dataset_cache(cache_dir, version):
+    """Return the long table of ``version`` stored by ``write_dataset_cache``, with string columns as categoricals."""
+    directory = dataset_cache_dir(cache_dir, version)
+    with open(os.path.join(directory, "columns.json")) as file:
+        categories = json.load(file)["categories"]
+    columns = {}
+    for column in DATA_COLUMNS:
+        values = np.load(os.path.join(directory, column + ".npy"))
+        if column in categories:
+            values = pd.Categorical.from_codes(values, categories[column])
+        columns[column] = values
+    return pd.DataFrame(columns)
+
+
+def dataset_cache_is_current(cache_dir, source):
+    """Check whether the cache in ``cache_dir`` was built from the current contents of ``source``.
+
+    A matching mtime and size is trusted as is. Otherwise the file is hashed, so a touched but unchanged CSV
+    only refreshes the recorded mtime instead of triggering a rebuild.
+    """
+    try:
+        with open(os.path.join(cache_dir, "meta.json")) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return False
+    if "sha256" not in meta or not os.path.isdir(dataset_cache_dir(cache_dir, meta["sha256"][:12])):
+        return False
+
+    stat = os.stat(source)
+    if meta["mtime_ns"] == stat.st_mtime_ns and meta["size"] == stat.st_size:
+        return True
+    if meta["sha256"] != file_digest(source):
+        return False
+
+    meta.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+    with atomic_write(os.path.join(cache_dir, "meta.json"), 'w') as file:
+        json.dump(meta, file)
+    return True
+
+
+def refresh_dataset_cache(source):
+    """Rebuild the columnar cache of a data source if its CSV has changed."""
+    if not dataset_cache_is_current(source.cache_dir, source.path):
+        write_dataset_cache(prepare_dataset(source), source.cache_dir, source.path)
+
+
+def dataset_version(cache_dir):
+    """Return the version of the dataset in the cache, the start of the source CSV's SHA-256."""
+    with open(os.path.join(cache_dir, "meta.json")) as file:
+        return json.load(file)["sha256"][:12]
+
+# -------------------------------------------------DATA STORE------------------------------------------------------
+
+
+class DataStore:
+    """Read-only dense view of the long table, indexed by (year, age, country).
+
+    ``rates[y, a, c]`` holds the fertility rate for ``years[y]``, ``ages[a]`` and ``countries[c]``; combinations
+    without data are NaN. The averages shown in the dashboard are precomputed, so callbacks only read slices and
+    never scan or copy the long table.
+
+    A store can be saved to a directory and opened from it memory-mapped, so that all worker processes on a host
+    share one read-only copy of the numeric arrays through the page cache.
+    """
+
+    ARRAYS = ['years', 'rates', 'deviations', 'ranking', 'ascending_ranking', 'ranked_counts', 'mean_by_year_age',
+              'mean_by_year', 'mean_by_age', 'max_by_country']
+
+    def __init__(self, dataframe, ages=None):
+        countries = dataframe[["country_name", "country_code"]].drop_duplicates("country_name")
+
+        # lookup tables between labels and integer positions; ages in the given order, sorted by default
+        self.years = np.sort(dataframe["year"].unique())
+        self.ages = np.array(list(ages) if ages is not None else sorted(dataframe["age"].unique()))
+        self.countries = countries["country_name"].to_numpy(dtype=object)
+        self.codes = countries["country_code"].to_numpy(dtype=object)
+
+        # scatter the long table into the dense cube
+        y = np.searchsorted(self.years, dataframe["year"].to_numpy())
+        a = pd.Index(self.ages).get_indexer(dataframe["age"])
+        c = pd.Index(self.countries).get_indexer(dataframe["country_name"])
+        self.rates = np.full((len(self.years), len(self.ages), len(self.countries)), np.nan, dtype=np.float32)
+        self.rates[y, a, c] = dataframe["rate"].to_numpy()
+
+        # averages over all countries with data (all-NaN slices stay NaN), accumulated in double precision
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            self.mean_by_year_age = np.nanmean(self.rates, axis=2, dtype=np.float64)
+            self.mean_by_year = np.nanmean(self.rates, axis=(1, 2), dtype=np.float64)
+            self.mean_by_age = np.nanmean(self.rates, axis=(0, 2), dtype=np.float64)
+            self.max_by_country = np.nanmax(self.rates, axis=(0, 1))
+
+        # deviation of every country from the mean of all countries in the same year and age group
+        self.deviations = (self.rates - self.mean_by_year_age[:, :, np.newaxis]).astype(np.float32)
+
+        # country positions per (year, age) from the highest to the lowest rate; countries without data come last
+        # (stable, so ties keep the order of the table)
+        self.ranking = np.argsort(-self.rates, axis=2, kind='stable').astype(np.int16)
+        # ranked on its own, as reversing the descending ranking would also reverse the order of tied rates
+        self.ascending_ranking = np.argsort(self.rates, axis=2, kind='stable').astype(np.int16)
+        self.ranked_counts = np.count_nonzero(~np.isnan(self.rates), axis=2).astype(np.int16)
+
+        self._index()
+
+    def _index(self):
+        self.year_index = {int(year): i for i, year in enumerate(self.years)}
+        self.age_index = {str(age): i for i, age in enumerate(self.ages)}
+        self.country_index = {str(country): i for i, country in enumerate(self.countries)}
+        for array in [self.ages, self.countries, self.codes] + [getattr(self, name) for name in self.ARRAYS]:
+            array.setflags(write=False)
+
+    def save(self, directory, version):
+        """Write the store to ``directory``, tagged with the ``version`` of the data it was built from."""
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            with atomic_write(os.path.join(directory, name + ".npy")) as file:
+                np.save(file, getattr(self, name))
+
+        labels = {"version": version, "ages": self.ages.tolist(), "countries": self.countries.tolist(),
+                  "codes": self.codes.tolist()}
+        with atomic_write(os.path.join(directory, "labels.json"), 'w') as file:
+            json.dump(labels, file)
+
+    @classmethod
+    def open(cls, directory, version, ages=None):
+        """Open a store saved with ``save``, memory-mapping its arrays read-only.
+
+        Raises ValueError if the store in ``directory`` was built from another version of the data or with ages in
+        another order than ``ages``.
+        """
+        with open(os.path.join(directory, "labels.json")) as file:
+            labels = json.load(file)
+        if labels["version"] != version or (ages is not None and labels["ages"] != list(ages)):
+            raise ValueError(f"store in {directory} is outdated")
+
+        store = cls.__new__(cls)
+        store.ages = np.array(labels["ages"])
+        store.countries = np.array(labels["countries"], dtype=object)
+        store.codes = np.array(labels["codes"], dtype=object)
+        for name in cls.ARRAYS:
+            setattr(store, name, np.load(os.path.join(directory, name + ".npy"), mmap_mode='r'))
+        store._index()
+        return store
+
+    def year_slice(self, year, age):
+        """Return the country positions and rates with data for one year and age group."""
+        rates = self.rates[self.year_index[int(year)], self.age_index[age]]
+        countries = np.flatnonzero(~np.isnan(rates))
+        return countries, rates[countries]
+
+    def country_series(self, country, age):
+        """Return the years and rates with data for one country and age group."""
+        rates = self.rates[:, self.age_index[age], self.country_index[country]]
+        years = np.flatnonzero(~np.isnan(rates))
+        return self.years[years], rates[years]
+
+    def countries_series(self, countries, age):
+        """Return the years and rates with data of several countries and one age group, read in a single gather."""
+        rates = self.rates[:, self.age_index[age], [self.country_index[country] for country in countries]]
+        series = []
+        for column in rates.T:
+            years = np.flatnonzero(~np.isnan(column))
+            series.append((self.years[years], column[years]))
+        return series
+
+    def top_countries(self, year, age, n):
+        """Return the positions of the ``n`` countries with the highest rates, highest first."""
+        y, a = self.year_index[int(year)], self.age_index[age]
+        return self.ranking[y, a, :min(n, self.ranked_counts[y, a])]
+
+    def bottom_countries(self, year, age, n):
+        """Return the positions of the ``n`` countries with the lowest rates, lowest first."""
+        y, a = self.year_index[int(year)], self.age_index[age]
+        return self.ascending_ranking[y, a, :min(n, self.ranked_counts[y, a])]
+
+    def percentile_band(self, year, age, lower, upper):
+        """Return the positions of the countries whose rate lies between the ``lower`` and ``upper`` percentile.
+
+        Percentiles count from the lowest rate, so ``percentile_band(year, age, 90, 100)`` is the top decile.
+        Countries are ordered from the highest rate to the lowest.
+        """
+        y, a = self.year_index[int(year)], self.age_index[age]
+        count = int(self.ranked_counts[y, a])
+        return self.ranking[y, a, count - int(count * upper / 100):count - int(count * lower / 100)]
+
+    def country_deviations(self, country, age):
+        """Return the years with data and the deviations from the yearly mean for one country and age group."""
+        deviations = self.deviations[:, self.age_index[age], self.country_index[country]]
+        years = np.flatnonzero(~np.isnan(deviations))
+        return self.years[years], deviations[years]
+
+
+def chart_values(values):
+    """Return float32 values of the store as float64 for the charts.
+
+    They are converted through their shortest representation, so the JSON of a figure holds the digits they were
+    stored with (``69.03482``) and not the float32 rounding error (``69.03482055664062``).
+    """
+    return np.asarray(values).astype(str).astype(np.float64)
+
+
+def load_store(cache_dir, version, ages=None):
+    """Return the data store, shared across workers through a memory-mapped copy if SHARED_STORE is set.
+
+    The long table is read from the dataset cache only to build a store; it is not kept afterwards, and not read
+    at all while the saved store is current.
+    """
+    if not SHARED_STORE:
+        return DataStore(read_dataset_cache(cache_dir, version), ages)
+
+    # every version has a store directory of its own, so a store being rewritten is never read
+    store_dir = os.path.join(cache_dir, "store", version)
+    try:
+        return DataStore.open(store_dir, version, ages)
+    except (OSError, ValueError, KeyError):
+        DataStore(read_dataset_cache(cache_dir, version), ages).save(store_dir, version)
+        return DataStore.open(store_dir, version, ages)
+
+
+# ------------------------------------------------MAP GEOMETRY-----------------------------------------------------
+
+# The world map draws simplified country outlines served from the assets folder (built with build_geometry.py) and
+# matches them on codes. The outline files map the FIPS 10-4 codes of the dataset to the ISO-3 ids of their features.
+
+GEOMETRY_FILE = os.path.join("geometry", f"countries_{MAP_GEOMETRY}.geojson")
+
+
+def load_geometry_codes(path):
+    """Return the lookup from FIPS 10-4 codes to the ISO-3 ids of the outlines in ``path``, None if it is missing."""
+    try:
+        with open(path) as file:
+            features = json.load(file)["features"]
+    except FileNotFoundError:
+        app.server.logger.warning("Map outlines %s not found, the world map falls back to matching plotly's outlines "
+                                  "by country name; build them with build_geometry.py", path)
+        return None
+    return {feature["properties"]["fips"]: feature["id"] for feature in features if feature["properties"]["fips"]}
+
+
+def map_locations(store):
+    """Return the map location of every country in ``store``; empty for countries without an outline."""
+    if geometry_codes is None:
+        return store.countries
+    locations = np.array([geometry_codes.get(code, "") for code in store.codes], dtype=object)
+    locations.setflags(write=False)
+    return locations
+
+
+geometry_codes = load_geometry_codes(os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets",
+                                                  GEOMETRY_FILE))
+
+# -------------------------------------------------FIGURE STORE----------------------------------------------------
+
+# ``python main.py --precompute`` renders the serialized figures of every overview and deep-dive view into the
+# dataset cache, under figures/<dataset version>/. The figures are concatenated into one pack named by the SHA-256 of
+# its content, with identical figure sets stored once, and index.json maps the digest of each view's inputs to its
+# offset and length in the pack. The index also records the digest of the settings, map outlines and code the
+# figures were rendered with (see figure_settings); a pack that does not match the running server is ignored.
+# Workers memory-map the pack, so all processes on a host share it through the page cache, and only render views
+# that are not in it.
+
+
+class FigureStore:
+    """Read-only, memory-mapped store of precomputed figures of one dataset version; empty if none were built."""
+
+    def __init__(self, directory=None, settings=None):
+        self.views = {}
+        self.hits = 0
+        self.misses = 0
+        self._pack = None
+        self._lock = threading.Lock()
+        if directory is None:
+            return
+        try:
+            with open(os.path.join(directory, "index.json")) as file:
+                index = json.load(file)
+            with open(os.path.join(directory, index["pack"]), 'rb') as file:
+                self._pack = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if index["views"] else b""
+        except (OSError, ValueError, KeyError):
+            return
+        # figures rendered with other settings or code are not served
+        if index.get("settings") == settings:
+            self.views = index["views"]
+
+    @staticmethod
+    def key(kind, *inputs):
+        """Return the digest a view is stored under, e.g. ``key("overview", 2020, "20-24")``."""
+        return hashlib.sha256(json.dumps([kind, *inputs]).encode()).hexdigest()
+
+    def get(self, kind, *inputs):
+        """Return the serialized figures of a view, or None if it was not precomputed."""
+        location = self.views.get(self.key(kind, *inputs))
+        with self._lock:
+            if location is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        offset, length = location
+        # figure JSON never contains a raw newline, so it separates the figures of a view
+        return tuple(self._pack[offset:offset + length].decode().split("\n"))
+
+    def stats(self):
+        with self._lock:
+            return {"views": len(self.views), "hits": self.hits, "misses": self.misses}
+
+
+def figure_store_dir(cache_dir, version):
+    return os.path.join(cache_dir, "figures", version)
+
+
+def figure_settings(source):
+    """Return the digest of everything besides the data that the figures of a data source are rendered from.
+
+    That is the settings that change the figures, the outlines of the world map, the data source (except where
+    its files are) and the versions of plotly and of this file.
+    """
+    with open(os.path.abspath(__file__), 'rb') as file:
+        code = hashlib.sha256(file.read()).hexdigest()
+    settings = {
+        "rate_decimals": RATE_DECIMALS,
+        "ranking_size": RANKING_SIZE,
+        "geometry": app.get_asset_url(GEOMETRY_FILE) if geometry_codes is not None else None,
+        "geometry_codes": geometry_codes,
+        "source": {field: value for field, value in source._asdict().items() if field not in ("path", "cache_dir")},
+        "plotly": plotly.__version__,
+        "code": code,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def open_figure_store(source, version):
+    if not PRECOMPUTED_FIGURES:
+        return FigureStore()
+    return FigureStore(figure_store_dir(source.cache_dir, version), figure_settings(source))
+
+
+def write_figure_store(source, version, rendered):
+    """Write the (key, serialized figures) pairs of ``rendered`` as the figure store of a dataset version.
+
+    The index is replaced last, so readers never see a half-written store, and the stores of other versions are
+    removed; workers that still have an old pack mapped keep reading it.
+    """
+    directory = figure_store_dir(source.cache_dir, version)
+    os.makedirs(directory, exist_ok=True)
+
+    views, offsets, digest, offset = {}, {}, hashlib.sha256(), 0
+    with atomic_write(os.path.join(directory, "pack")) as file:
+        for key, figures in rendered:
+            data = "\n".join(figures).encode()
+            content = hashlib.sha256(data).hexdigest()
+            if content not in offsets:
+                offsets[content] = (offset, len(data))
+                file.write(data)
+                digest.update(data)
+                offset += len(data)
+            views[key] = offsets[content]
+    # the pack is named by its content, so a pack that is mapped by a worker is never overwritten
+    pack = digest.hexdigest() + ".pack"
+    os.replace(os.path.join(directory, "pack"), os.path.join(directory, pack))
+
+    with atomic_write(os.path.join(directory, "index.json"), 'w') as file:
+        json.dump({"pack": pack, "settings": figure_settings(source), "views": views}, file)
+
+    for name in os.listdir(directory):
+        if name.endswith(".pack") and name != pack:
+            os.remove(os.path.join(directory, name))
+    remove_versions(os.path.dirname(directory), {version})
+    return len(views), offset
+
+
+# -----------------------------------------------DATASET VERSIONS--------------------------------------------------
+
+# The store of a dataset version and everything derived from it are published together as one immutable Dataset. A
+# reload builds a new Dataset in the background and swaps it in with a single assignment; every request pins the
+# Dataset it first sees, so it works on one consistent version even if a reload completes while it is running.
+#
+# Every data source has its own Dataset. Only the default source is loaded at startup, the others on their first
+# request; the page selects one with its ``dataset`` query parameter.
+
+Dataset = namedtuple("Dataset", ["version", "store", "locations", "options", "source", "nbytes", "figures"])
+
+
+# at most this many years are marked on the year slider; longer ranges are marked every 10, 20, ... years
+SLIDER_MARKS = 14
+
+
+def slider_years(years):
+    """Return the years of a store that are marked on the year slider, every fifth one for up to 70 years.
+
+    Datasets with too few years on such a step have all of their years marked.
+    """
+    span = int(years.max()) - int(years.min())
+    step = 5 * max(-(-span // (5 * SLIDER_MARKS)), 1)
+    marked = [int(year) for year in years if year % step == 0]
+    return marked if len(marked) >= 2 else [int(year) for year in years]
+
+
+def layout_options(store, source):
+    """Return the year range and slider marks, the selector options and the country shown before the first click.
+
+    Ages keep the order of the store, countries are sorted by name. The default country is the data source's, or
+    the first one by name if the dataset does not have it.
+    """
+    ages = [str(age) for age in store.ages]
+    countries = sorted([{"label": str(country), "value": str(country)} for country in store.countries],
+                       key=lambda x: x['label'])
+    return {
+        "years": (int(store.years.min()), int(store.years.max())),
+        "year_marks": {str(year): str(year) for year in slider_years(store.years)},
+        "age_buttons": [{"label": "age " + age, "value": age} for age in ages],
+        "ages": [{"label": age, "value": age} for age in ages],
+        "countries": countries,
+        "country": source.default_country if source.default_country in store.country_index
+        else countries[0]["value"],
+    }
+
+
+def dataset_nbytes(store):
+    """Return the memory taken by a store, memory-mapped arrays included."""
+    return sum(value.nbytes for value in vars(store).values() if isinstance(value, np.ndarray))
+
+
+def make_dataset(version, store, source=FERTILITY):
+    """Return the Dataset of a store, with the map locations and layout options derived."""
+    locations = map_locations(store)
+    unmatched = store.countries[locations == ""]
+    if len(unmatched):
+        app.server.logger.warning("%d countries of %s have no outline on the world map: %s", len(unmatched),
+                                  source.id, ", ".join(unmatched))
+    return Dataset(version, store, locations, layout_options(store, source), source, dataset_nbytes(store),
+                   open_figure_store(source, version))
+
+
+def open_dataset(source):
+    """Load the dataset of a data source (through its columnar cache) and build its data store."""
+    refresh_dataset_cache(source)
+    version = dataset_version(source.cache_dir)
+    ages = list(source.measures.values())
+    return make_dataset(version, load_store(source.cache_dir, version, ages), source)
+
+
+class DatasetRegistry:
+    """The datasets of all data sources, each loaded on its first use.
+
+    Loaded datasets stay resident while their total size is within ``budget`` bytes; beyond that the least
+    recently used ones are unloaded, except the one loaded last. Requests still working on an unloaded dataset keep
+    it alive until they finish.
+    """
+
+    def __init__(self, sources, budget):
+        self.sources = OrderedDict((source.id, source) for source in sources)
+        self.budget = budget
+        self.loads = 0
+        self.evictions = 0
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {source_id: threading.Lock() for source_id in self.sources}
+
+    def _lookup(self, source_id):
+        with self._lock:
+            found = self._resident.get(source_id)
+            if found is not None:
+                self._resident.move_to_end(source_id)
+            return found
+
+    def get(self, source_id):
+        """Return the dataset of a source, loading it if it is not resident. Raises KeyError for unknown ids."""
+        found = self._lookup(source_id)
+        if found is not None:
+            return found
+        # only requests for the same source wait while it is loaded
+        with self._loading[source_id]:
+            found = self._lookup(source_id)
+            if found is None:
+                found = open_dataset(self.sources[source_id])
+                self.put(found)
+                app.server.logger.info("Loaded dataset %s, version %s, %.1f MB", source_id, found.version,
+                                       found.nbytes / 2 ** 20)
+            return found
+
+    def put(self, new_dataset):
+        """Make ``new_dataset`` the resident dataset of its source and unload others while over the budget."""
+        with self._lock:
+            self.loads += new_dataset.source.id not in self._resident
+            self._resident[new_dataset.source.id] = new_dataset
+            self._resident.move_to_end(new_dataset.source.id)
+            while len(self._resident) > 1 and sum(d.nbytes for d in self._resident.values()) > self.budget:
+                source_id, _ = self._resident.popitem(last=False)
+                self.evictions += 1
+                app.server.logger.info("Unloaded dataset %s to stay within the memory budget", source_id)
+
+    def resident(self):
+        with self._lock:
+            return list(self._resident.values())
+
+    def stats(self):
+        with self._lock:
+            return {"sources": list(self.sources), "budget_bytes": int(self.budget),
+                    "resident_bytes": {source_id: d.nbytes for source_id, d in self._resident.items()},
+                    "loads": self.loads, "evictions": self.evictions}
+
+
+def requested_source():
+    """Return the id of the data source the current request is for.
+
+    Pages select it with their ``dataset`` query parameter; the layout and callback requests of a page carry it in
+    their Referer. Missing and unknown ids select the default source.
+    """
+    source_id = request.args.get("dataset")
+    if source_id is None and request.referrer:
+        source_id = parse_qs(urlsplit(request.referrer).query).get("dataset", [None])[0]
+    return source_id if source_id in datasets.sources else DEFAULT_SOURCE
+
+
+def current_dataset():
+    """Return the dataset pinned to the current request, or the newest default dataset outside of requests."""
+    if not has_request_context():
+        return datasets.get(DEFAULT_SOURCE)
+    if "dataset" not in g:
+        g.dataset = datasets.get(requested_source())
+    return g.dataset
+
+
+def current_store():
+    return current_dataset().store
+
+
+def swap_dataset(new_dataset):
+    """Publish ``new_dataset`` for its source and drop the figures rendered from the version it replaces.
+
+    The cached figures of other datasets are kept.
+    """
+    old = next((d for d in datasets.resident() if d.source.id == new_dataset.source.id), None)
+    datasets.put(new_dataset)
+    if old is not None and old.version != new_dataset.version:
+        for cache in (figure_cache, patch_cache, country_cache, response_cache):
+            cache.evict_version(old.version)
+
+
+def watch_datasets(interval):
+    """Check the CSVs of the resident datasets every ``interval`` seconds and swap in the ones that have changed.
+
+    A dataset is reopened when its CSV has changed, and also when its cache holds another version than the one in
+    memory, which happens when another worker or ``--ingest`` has rebuilt the shared cache; only a stale cache is
+    rebuilt. Runs in a background thread, so rebuilding the cache and the store never blocks a request. If loading
+    fails, the current dataset stays in place and the next check tries again.
+    """
+    while True:
+        time.sleep(interval)
+        for old in datasets.resident():
+            source = old.source
+            try:
+                if (dataset_cache_is_current(source.cache_dir, source.path)
+                        and dataset_version(source.cache_dir) == old.version):
+                    continue
+                new_dataset = open_dataset(source)
+                if new_dataset.version != old.version:
+                    swap_dataset(new_dataset)
+                    server.logger.info("Reloaded %s, dataset version %s", source.path, new_dataset.version)
+                    if source.id == DEFAULT_SOURCE:
+                        warm_caches()
+            except Exception:
+                server.logger.exception("Reloading %s failed, keeping dataset version %s", source.path, old.version)
+
+
+DEFAULT_SOURCE = FERTILITY.id
+datasets = DatasetRegistry([FERTILITY] + (read_data_sources(DATA_SOURCES) if DATA_SOURCES else []),
+                           DATASET_MEMORY_MB * 2 ** 20)
+datasets.get(DEFAULT_SOURCE)
+startup.mark("dataset")
+
+# -------------------------------------------------INSTRUMENTATION-------------------------------------------------
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block (or decorated function) to ``phase`` of the current callback request.
+
+    Callbacks are decorated with ``timed("callback")`` and mark their ``prep`` and ``serialize`` phases; the rest
+    of the callback counts as figure build. Outside of an instrumented request this does nothing.
+    """
+    if not (CALLBACK_METRICS and has_request_context() and "phases" in g):
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.phases[phase] = g.phases.get(phase, 0.0) + time.perf_counter() - start
+
+
+class CallbackMetrics:
+    """Thread-safe aggregate of callback timings and response sizes, rendered in Prometheus text format.
+
+    Values are kept per process, so with several workers every worker reports its own series.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, payload_sample):
+        self.payload_sample = payload_sample
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._durations = {}
+        self._phases = {}
+        self._response_bytes = {}
+        self._output_bytes = {}
+
+    def sample_payload(self):
+        """Return whether the response of the next request should be broken down by output."""
+        with self._lock:
+            self._requests += 1
+            return self.payload_sample > 0 and self._requests % self.payload_sample == 0
+
+    def observe(self, callback, total, phases, response_bytes, output_bytes=None):
+        with self._lock:
+            buckets, count, seconds = self._durations.get(callback, ([0] * len(self.BUCKETS), 0, 0.0))
+            buckets = [n + (total <= bound) for n, bound in zip(buckets, self.BUCKETS)]
+            self._durations[callback] = (buckets, count + 1, seconds + total)
+            for phase, duration in phases.items():
+                self._phases[callback, phase] = self._phases.get((callback, phase), 0.0) + duration
+            self._response_bytes[callback] = self._response_bytes.get(callback, 0) + response_bytes
+            for output, size in (output_bytes or {}).items():
+                count, total_size = self._output_bytes.get(output, (0, 0))
+                self._output_bytes[output] = (count + 1, total_size + size)
+
+    def render(self, caches):
+        """Return all metrics, plus the counters of the given figure caches, in Prometheus text format."""
+        lines = ["# HELP dashboard_callback_duration_seconds Wall time of Dash callback requests.",
+                 "# TYPE dashboard_callback_duration_seconds histogram"]
+        with self._lock:
+            for callback, (buckets, count, seconds) in sorted(self._durations.items()):
+                for bound, n in zip(self.BUCKETS + ("+Inf",), buckets + [count]):
+                    lines.append(f'dashboard_callback_duration_seconds_bucket{{callback="{callback}",le="{bound}"}} '
+                                 f'{n}')
+                lines.append(f'dashboard_callback_duration_seconds_sum{{callback="{callback}"}} {seconds}')
+                lines.append(f'dashboard_callback_duration_seconds_count{{callback="{callback}"}} {count}')
+
+            lines += ["# HELP dashboard_callback_phase_seconds_total Time spent per callback phase "
+                      "(prep, build, serialize, cache).",
+                      "# TYPE dashboard_callback_phase_seconds_total counter"]
+            for (callback, phase), seconds in sorted(self._phases.items()):
+                lines.append(f'dashboard_callback_phase_seconds_total{{callback="{callback}",phase="{phase}"}} '
+                             f'{seconds}')
+
+            lines += ["# HELP dashboard_callback_response_bytes_total Bytes of callback responses.",
+                      "# TYPE dashboard_callback_response_bytes_total counter"]
+            for callback, size in sorted(self._response_bytes.items()):
+                lines.append(f'dashboard_callback_response_bytes_total{{callback="{callback}"}} {size}')
+
+            lines += ["# HELP dashboard_output_response_bytes Bytes per output in sampled callback responses.",
+                      "# TYPE dashboard_output_response_bytes summary"]
+            for output, (count, size) in sorted(self._output_bytes.items()):
+                lines.append(f'dashboard_output_response_bytes_sum{{output="{output}"}} {size}')
+                lines.append(f'dashboard_output_response_bytes_count{{output="{output}"}} {count}')
+
+        stats = {name: cache.stats() for name, cache in caches.items()}
+        for metric, kind, key, description in [("hits_total", "counter", "hits", "Figure cache hits."),
+                                               ("misses_total", "counter", "misses", "Figure cache misses."),
+                                               ("entries", "gauge", "size", "Entries in the figure cache.")]:
+            lines += [f"# HELP dashboard_figure_cache_{metric} {description}",
+                      f"# TYPE dashboard_figure_cache_{metric} {kind}"]
+            for name in stats:
+                lines.append(f'dashboard_figure_cache_{metric}{{cache="{name}"}} {stats[name][key]}')
+        return "\n".join(lines) + "\n"
+
+
+callback_metrics = CallbackMetrics(METRICS_PAYLOAD_SAMPLE)
+
+# -------------------------------------------------FIGURE CACHE----------------------------------------------------
+
+
+class FigureCache:
+    """Thread-safe LRU cache of serialized figures with a bounded number of entries.
+
+    Values are stored as figure JSON, so a hit skips building the figures and plotly's conversion of their numpy
+    arrays. Dash still encodes the decoded figures into the response; repeated requests are answered without that
+    by the response cache. ``hits`` and ``misses`` count the lookups since startup.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_build(self, key, build):
+        """Return the cached value for ``key``, calling ``build()`` and storing its result on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def evict_version(self, version):
+        """Remove the entries of one dataset version, whose keys all start with it."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == version]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+@timed("serialize")
+def serialize_figures(figures):
+    """Return the figures (or patches) as JSON strings, as stored in the figure caches."""
+    from plotly.io.json import to_json_plotly
+
+    return tuple(to_json_plotly(figure) for figure in figures)
+
+
+@timed("serialize")
+def deserialize_figures(serialized):
+    """Return cached figures as plain dicts, which Dash encodes without validating or converting them again."""
+    return [json.loads(figure) for figure in serialized]
+
+
+figure_cache = FigureCache(FIGURE_CACHE_SIZE)
+patch_cache = FigureCache(FIGURE_CACHE_SIZE)
+country_cache = FigureCache(COUNTRY_CACHE_SIZE)
 
 # ----------------------------------------------LAYOUT DEFINITION---------------------------------------------------
 
 server = app.server
 app.config.suppress_callback_exceptions = True
 
-app.layout = html.Div([
-    # Header Section
-    dbc.Row([
-        dbc.Col([
-            dbc.Card([
-                dbc.CardBody([
-                    html.Br(),
-                    html.H1('Fertility Rate Analysis'),
-                    html.P("The Fertility Rate represents the number of births in a population per 1,000 women "
-                           "of reproductive age in a given year. Over the past 50 years, fertility rates have "
-                           "experienced a steady global decline. This trend can be attributed to several factors,"
-                           " including the postponement of family formation and childbearing, as well as a decrease "
-                           "in the desired size of families. This dashboard visualizes the change in fertility rates "
-                           "for different age groups since 1970."),
-                    html.P("Source: The U.S. Census Bureau")
-                ], style={"background-color": "#EAEAEA"}),
-            ], style={"border": "none"})
-        ])], className='p-1 hidden'),
-    dbc.Row([
-        dbc.Col([
-            # Section with Year Slider and Age Buttons
-            dbc.Card([
-                dbc.CardBody([
-                    html.Br(),
-                    html.Div("Drag the slider to change the year:", className='instructions'),
-                    dcc.Slider(
-                        min=df['year'].min(),
-                        max=df['year'].max(),
-                        step=None,
-                        marks={year: str(year) for year in range(1955, 2051, 5)},
-                        value=df['year'].max(),
-                        id='year_slider',
-                        tooltip={"placement": "bottom", "always_visible": True, },
-                        className="year_selection--slider",
-                    ),
-                    html.Br(),
-                    html.Div("Select an age group:", className='instructions'),
-                    html.Div(
-                        [
-                            dbc.RadioItems(
-                                id="age_buttons",
-                                className="btn-group",
-                                inputClassName="btn-check",
-                                labelClassName="btn btn-outline-primary",
-                                labelCheckedClassName="active",
-                                options=sorted(
-                                    [{"label": "age " + str(i), "value": str(i)} for i in df["age"].unique()],
-                                    key=lambda x: x['label']),
-                                value='15-19',
-                            ),
-                            html.Div(id="output"),
-                        ], className="radio-group", )
-                ])
-            ], ),
-            # Section with World Map
-            dbc.Row([
-                dbc.Col([
-                    dbc.Card([
-                        dbc.CardBody([
-                            html.Br(),
-                            html.H2("The Fertility Rate across the World"),
-                            html.H3("The highest fertility rate across all years is achieved by women between 25-29"
-                                    " years."),
-                            html.Hr(),
-                            html.P("This heatmap illustrates the fertility rate for each country in the world. "
-                                   "Dark blue countries have relatively low fertility rates, while red shaded countries"
-                                   " have the highest fertility rates among women of the selected age. Please note that"
-                                   " for white shaded countries no data is available for the selected year."),
-                            html.Br(),
-                            html.P("Click on a country to find out more about its fertility rates below.",
-                                   style={'font-style': 'italic'}),
-                            dbc.Col(dcc.Graph(id='world_map', figure={})),
-                            html.Br(),
-                            (html.P(id='info_country', children=[], )),
-                        ])
-                    ])
-                ])
-            ], className='mt-4'),
-            # Section with text boxes
-            dbc.Row([
-                dbc.Col([
-                    dbc.Card([
-                        dbc.CardBody([
-                            dbc.Col(
-                                [dbc.Col(html.P(id='container_1_value', children=[], className='container',
-                                                style={'font-size': '40px', 'font-weight': 'bold'})),
-                                 dbc.Col(html.P(id='container_1_text', children=[], className='container')),
-                                 ]),
-                        ], )
+
+def serve_layout():
+    """Build the page for a new visitor, with the slider range and option lists of the current dataset."""
+    source = current_dataset().source
+    options = current_dataset().options
+    # links between the datasets, when there is more than one
+    dataset_links = []
+    if len(datasets.sources) > 1:
+        dataset_links.append(dbc.Nav([dbc.NavLink(other.title, href=f"?dataset={other.id}",
+                                                  active=other.id == source.id, external_link=True)
+                                      for other in datasets.sources.values()], pills=True))
+    return html.Div([
+        # Header Section
+        dbc.Row([
+            dbc.Col([
+                dbc.Card([
+                    dbc.CardBody([
+                        html.Br(),
+                        html.H1(source.title),
+                        *dataset_links,
+                        html.P(source.description),
+                        html.P("Source: The U.S. Census Bureau")
+                    ], style={"background-color": "#EAEAEA"}),
+                ], style={"border": "none"})
+            ])], className='p-1 hidden'),
+        dbc.Row([
+            dbc.Col([
+                # Section with Year Slider and Age Buttons
+                dbc.Card([
+                    dbc.CardBody([
+                        html.Br(),
+                        html.Div("Drag the slider to change the year:", className='instructions'),
+                        dcc.Slider(
+                            min=options["years"][0],
+                            max=options["years"][1],
+                            step=None,
+                            marks=options["year_marks"],
+                            value=options["years"][1],
+                            id='year_slider',
+                            tooltip={"placement": "bottom", "always_visible": True, },
+                            className="year_selection--slider",
+                        ),
+                        html.Div([
+                            dbc.Button("Play", id='play_button', n_clicks=0, color="primary", outline=True, size="sm"),
+                            html.Span(id='playback_year', className='instructions'),
+                            dcc.Interval(id='playback_interval', interval=PLAYBACK_INTERVAL_MS, disabled=True),
+                            dcc.Store(id='playback_frames'),
+                        ]),
+                        html.Br(),
+                        html.Div("Select an age group:", className='instructions'),
+                        html.Div(
+                            [
+                                dbc.RadioItems(
+                                    id="age_buttons",
+                                    className="btn-group",
+                                    inputClassName="btn-check",
+                                    labelClassName="btn btn-outline-primary",
+                                    labelCheckedClassName="active",
+                                    options=options["age_buttons"],
+                                    value=options["ages"][0]["value"],
+                                ),
+                                html.Div(id="output"),
+                            ], className="radio-group", )
                     ])
-                ]),
-                dbc.Col([
-                    dbc.Card([
-                        dbc.CardBody([
-                            dbc.Col(
-                                [dbc.Col(html.P(id='container_2_value', children=[], className='container',
-                                                style={'font-size': '40px', 'font-weight': 'bold'})),
-                                 dbc.Col(html.P(id='container_2_text', children=[], className='container')),
-                                 ]),
+                ], ),
+                # Section with World Map
+                dbc.Row([
+                    dbc.Col([
+                        dbc.Card([
+                            dbc.CardBody([
+                                html.Br(),
+                                html.H2("The Fertility Rate across the World"),
+                                html.H3("The highest fertility rate across all years is achieved by women between 25-29"
+                                        " years."),
+                                html.Hr(),
+                                html.P("This heatmap illustrates the fertility rate for each country in the world. "
+                                       "Dark blue countries have relatively low fertility rates, while red shaded "
+                                       "countries have the highest fertility rates among women of the selected age. "
+                                       "Please note that for white shaded countries no data is available for the "
+                                       "selected year."),
+                                html.Br(),
+                                html.P("Click on a country to find out more about its fertility rates below.",
+                                       style={'font-style': 'italic'}),
+                                dbc.Col(dcc.Graph(id='world_map', figure={})),
+                                dcc.Store(id='selected_country', data=options["country"]),
+                                html.Br(),
+                                (html.P(id='info_country', children=[], )),
+                            ])
                         ])
-                    ], )
-                ]),
-                dbc.Col([
-                    dbc.Card([
-                        dbc.CardBody([
-                            dbc.Col(
-                                [
-                                    dbc.Col(html.P(id='container_3_value', children=[], className='container',
-                                                   style={'font-size': '40px', 'font-weight': 'bold'})),
-                                    dbc.Col(
-                                        html.P(id='container_3_text', children=[], className='container')),
-                                ]),
+                    ])
+                ], className='mt-4'),
+                # Section with text boxes
+                dbc.Row([
+                    dbc.Col([
+                        dbc.Card([
+                            dbc.CardBody([
+                                dbc.Col(
+                                    [dbc.Col(html.P(id='container_1_value', children=[], className='container',
+                                                    style={'font-size': '40px', 'font-weight': 'bold'})),
+                                     dbc.Col(html.P(id='container_1_text', children=[], className='container')),
+                                     ]),
+                            ], )
                         ])
-                    ], )
-                ]),
-
-            ], className='mt-4'),
-        ], xs=8),
-        # Section with TOP 10 and LOW 10 charts
-        dbc.Col([
-            dbc.Card([
-                dbc.CardBody([
-                    html.H2("The 10 countries with the highest fertility rates"),
-                    html.H3("Countries with comparatively high fertility rates are mostly located in Africa."),
-                    dbc.Col(dcc.Graph(id='top10_barchart', figure={}), className='barchart'),
-                    html.Br(),
-                    html.Hr(),
-                    html.Br(),
-                    html.H2("The 10 countries with the lowest fertility rates"),
-                    html.H3("Countries with comparatively low fertility rates are mostly located in Europe and "
-                            "South East Asia."),
-                    dbc.Col(dcc.Graph(id='low10_barchart', figure={}, className='barchart')),
-                ], )
-            ])
-        ], xs=4),
-    ], align='start', className='p-3 hidden'),
-    # Section with second Header
-    dbc.Row([
-        dbc.Col([
-            dbc.Card([
-                dbc.CardBody([
-                    (html.H1(id='headline_2', children=[], )),
-                    html.P("The following charts provide a deep dive into fertility rates for the selected country."),
-                ], style={"background-color": "#EAEAEA"}),
-            ], style={"border": "none"})
-        ])], className='p-1 hidden'),
-    # Section with Development of Fertility Rates for each Country
-    dbc.Row([
-        dbc.Col([
-            dbc.Card([
-                dbc.CardBody([
-                    dbc.Col(html.H2(id='headline_rates_development', children=[])),
-                    html.H3("In European countries such as France and Germany, a clear upward age shift can be observed"
-                            " among expectant mothers."),
-                    html.Hr(),
-                    html.P("The charts below show the evolution of the fertility rate for each age group, as well as "
-                           "the percentage evolution of the rate from the first year of record to 2023."),
-                    html.Br(),
-                    html.Br(),
-                    dbc.Row([
-                        dbc.Col(dcc.Graph(id='bar_chart_19', figure={}), lg=10),
-                        dbc.Col(dcc.Graph(id='indicator_19', figure={}), lg=2)
                     ]),
-                    html.Br(),
-                    dbc.Row([
-                        dbc.Col(dcc.Graph(id='bar_chart_24', figure={}), lg=10),
-                        dbc.Col(dcc.Graph(id='indicator_24', figure={}), lg=2)
-                    ]),
-                    html.Br(),
-                    dbc.Row([
-                        dbc.Col(dcc.Graph(id='bar_chart_29', figure={}), lg=10),
-                        dbc.Col(dcc.Graph(id='indicator_29', figure={}), lg=2)
-                    ]),
-                    html.Br(),
-                    dbc.Row([
-                        dbc.Col(dcc.Graph(id='bar_chart_34', figure={}), lg=10),
-                        dbc.Col(dcc.Graph(id='indicator_34', figure={}), lg=2)
+                    dbc.Col([
+                        dbc.Card([
+                            dbc.CardBody([
+                                dbc.Col(
+                                    [dbc.Col(html.P(id='container_2_value', children=[], className='container',
+                                                    style={'font-size': '40px', 'font-weight': 'bold'})),
+                                     dbc.Col(html.P(id='container_2_text', children=[], className='container')),
+                                     ]),
+                            ])
+                        ], )
                     ]),
-                    html.Br(),
-                    dbc.Row([
-                        dbc.Col(dcc.Graph(id='bar_chart_39', figure={}), lg=10),
-                        dbc.Col(dcc.Graph(id='indicator_39', figure={}), lg=2)
+                    dbc.Col([
+                        dbc.Card([
+                            dbc.CardBody([
+                                dbc.Col(
+                                    [
+                                        dbc.Col(html.P(id='container_3_value', children=[], className='container',
+                                                       style={'font-size': '40px', 'font-weight': 'bold'})),
+                                        dbc.Col(
+                                            html.P(id='container_3_text', children=[], className='container')),
+                                    ]),
+                            ])
+                        ], )
                     ]),
-                    html.Br(),
-                    dbc.Row([
-                        dbc.Col(dcc.Graph(id='bar_chart_44', figure={}), lg=10),
-                        dbc.Col(dcc.Graph(id='indicator_44', figure={}), lg=2)
+
+                ], className='mt-4'),
+            ], xs=8),
+            # Section with TOP 10 and LOW 10 charts
+            dbc.Col([
+                dbc.Card([
+                    dbc.CardBody([
+                        html.H2(f"The {RANKING_SIZE} countries with the highest fertility rates"),
+                        html.H3("Countries with comparatively high fertility rates are mostly located in Africa."),
+                        dbc.Col(dcc.Graph(id='top10_barchart', figure={}), className='barchart'),
+                        html.Br(),
+                        html.Hr(),
+                        html.Br(),
+                        html.H2(f"The {RANKING_SIZE} countries with the lowest fertility rates"),
+                        html.H3("Countries with comparatively low fertility rates are mostly located in Europe and "
+                                "South East Asia."),
+                        dbc.Col(dcc.Graph(id='low10_barchart', figure={}, className='barchart')),
+                    ], )
+                ])
+            ], xs=4),
+        ], align='start', className='p-3 hidden'),
+        # Section with second Header
+        dbc.Row([
+            dbc.Col([
+                dbc.Card([
+                    dbc.CardBody([
+                        (html.H1(id='headline_2', children=[], )),
+                        html.P("The following charts provide a deep dive into fertility rates for the selected "
+                               "country."),
+                    ], style={"background-color": "#EAEAEA"}),
+                ], style={"border": "none"})
+            ])], className='p-1 hidden'),
+        # Section with Development of Fertility Rates for each Country
+        dbc.Row([
+            dbc.Col([
+                dbc.Card([
+                    dbc.CardBody([
+                        dbc.Col(html.H2(id='headline_rates_development', children=[])),
+                        html.H3("In European countries such as France and Germany, a clear upward age shift can be "
+                                "observed among expectant mothers."),
+                        html.Hr(),
+                        html.P("The charts below show the evolution of the fertility rate for each age group, as well "
+                               "as the percentage evolution of the rate from the first year of record to 2023."),
+                        html.Br(),
+                        html.Br(),
+                        dbc.Row([
+                            dbc.Col(dcc.Graph(id='bar_chart_19', figure={}), lg=10),
+                            dbc.Col(dcc.Graph(id='indicator_19', figure={}), lg=2)
+                        ]),
+                        html.Br(),
+                        dbc.Row([
+                            dbc.Col(dcc.Graph(id='bar_chart_24', figure={}), lg=10),
+                            dbc.Col(dcc.Graph(id='indicator_24', figure={}), lg=2)
+                        ]),
+                        html.Br(),
+                        dbc.Row([
+                            dbc.Col(dcc.Graph(id='bar_chart_29', figure={}), lg=10),
+                            dbc.Col(dcc.Graph(id='indicator_29', figure={}), lg=2)
+                        ]),
+                        html.Br(),
+                        dbc.Row([
+                            dbc.Col(dcc.Graph(id='bar_chart_34', figure={}), lg=10),
+                            dbc.Col(dcc.Graph(id='indicator_34', figure={}), lg=2)
+                        ]),
+                        html.Br(),
+                        dbc.Row([
+                            dbc.Col(dcc.Graph(id='bar_chart_39', figure={}), lg=10),
+                            dbc.Col(dcc.Graph(id='indicator_39', figure={}), lg=2)
+                        ]),
+                        html.Br(),
+                        dbc.Row([
+                            dbc.Col(dcc.Graph(id='bar_chart_44', figure={}), lg=10),
+                            dbc.Col(dcc.Graph(id='indicator_44', figure={}), lg=2)
+                        ]),
+                        html.Br()
                     ]),
-                    html.Br()
                 ]),
-            ]),
-        ], xs=6),
-        # Section with Country Comparison
-        dbc.Col([
-            dbc.Card([
-                dbc.CardBody([
-                    html.H2("Country Comparison"),
-                    html.H3("Countries' fertility rates converge over time across all age groups."),
-                    html.Hr(),
-                    html.P("In this chart, individual countries can be compared with each other in terms of the "
-                           "development of their fertility rates over the years."),
-                    dbc.Row([
-                        dbc.Col([
-                            html.Div("Select the countries:", className='instructions'),
-                            dcc.Dropdown(id='dropdown_countries',
-                                         options=sorted(
-                                             [{"label": str(i), "value": str(i)} for i in
-                                              df["country_name"].unique()], key=lambda x: x['label']),
-                                         multi=True,
-                                         style={'height': '70px', 'width': '120%'},
-                                         className="dropdown"
-                                         )]),
-                        dbc.Col([
-                            html.Div("Select an age group:", className='instructions'),
-                            dcc.Dropdown(id='dropdown_age_1',
-                                         options=sorted(
-                                             [{"label": str(i), "value": str(i)} for i in
-                                              df["age"].unique()], key=lambda x: x['label']),
-                                         multi=False,
-                                         value='15-19',
-                                         className="dropdown",
-                                         )]),
+            ], xs=6),
+            # Section with Country Comparison
+            dbc.Col([
+                dbc.Card([
+                    dbc.CardBody([
+                        html.H2("Country Comparison"),
+                        html.H3("Countries' fertility rates converge over time across all age groups."),
+                        html.Hr(),
+                        html.P("In this chart, individual countries can be compared with each other in terms of the "
+                               "development of their fertility rates over the years."),
+                        dbc.Row([
+                            dbc.Col([
+                                html.Div("Select the countries:", className='instructions'),
+                                dcc.Dropdown(id='dropdown_countries',
+                                             options=options["countries"],
+                                             multi=True,
+                                             style={'height': '70px', 'width': '120%'},
+                                             className="dropdown"
+                                             )]),
+                            dbc.Col([
+                                html.Div("Select an age group:", className='instructions'),
+                                dcc.Dropdown(id='dropdown_age_1',
+                                             options=options["ages"],
+                                             multi=False,
+                                             value=options["ages"][0]["value"],
+                                             className="dropdown",
+                                             )]),
+                        ]),
+                        dbc.Col(dcc.Graph(id='line_chart_country_comparison', figure={})),
+                    ])
+                ], className="mb-4", ),
+                # Section with Deviation from mean fertility rate
+                dbc.Card([
+                    dbc.CardBody([
+                        dbc.Col(html.H2(id='headline_deviation', children=[])),
+                        html.H3("Most countries are either exclusively above average or below average fertility "
+                                "rates."),
+                        html.Hr(),
+                        html.P("This figure shows for each country the deviation from the average fertility rate for "
+                               "all countries."),
+                        dbc.Row([
+                            dbc.Col([
+                                html.Div("Select an age group:", className='instructions'),
+                                dcc.Dropdown(id='dropdown_age_2',
+                                             options=options["ages"],
+                                             multi=False,
+                                             value=options["ages"][0]["value"],
+                                             className="dropdown",
+                                             style={'width': '60%'},
+                                             )]),
+                        ]),
+                        dbc.Col(dcc.Graph(id='bar_chart_deviation', figure={}, className='barchart'))
                     ]),
-                    dbc.Col(dcc.Graph(id='line_chart_country_comparison', figure={})),
                 ])
-            ], className="mb-4", ),
-            # Section with Deviation from mean fertility rate
-            dbc.Card([
-                dbc.CardBody([
-                    dbc.Col(html.H2(id='headline_deviation', children=[])),
-                    html.H3("Most countries are either exclusively above average or below average fertility rates."),
-                    html.Hr(),
-                    html.P("This figure shows for each country the deviation from the average fertility rate for all "
-                           "countries."),
-                    dbc.Row([
-                        dbc.Col([
-                            html.Div("Select an age group:", className='instructions'),
-                            dcc.Dropdown(id='dropdown_age_2',
-                                         options=sorted(
-                                             [{"label": str(i), "value": str(i)} for i in
-                                              df["age"].unique()], key=lambda x: x['label']),
-                                         multi=False,
-                                         value='15-19',
-                                         className="dropdown",
-                                         style={'width': '60%'},
-                                         )]),
-                    ]),
-                    dbc.Col(dcc.Graph(id='bar_chart_deviation', figure={}, className='barchart'))
-                ]),
-            ])
-        ], xs=6)
-    ], className='p-3 hidden'),
-])
+            ], xs=6)
+        ], className='p-3 hidden'),
+    ])
+
+
+app.layout = serve_layout
+startup.mark("layout")
+
+
+# ----------------------------------------------FIGURE TEMPLATES---------------------------------------------------
+
+# Every chart is built once with plotly.express from a one-row sample and kept as a plain dict. The callbacks copy
+# the template traces and fill in only the data arrays, which gives the same figures without running px's
+# DataFrame handling and plotly's validation on every request. Templates are built on first use, so that importing
+# plotly.express and loading the theme do not delay the startup.
+
+def diverging_scale():
+    """Return the colorlover RdBu scale with the two middle colors replaced by the dashboard colors."""
+    import colorlover as cl
+
+    # Define the colors for the diverging scale
+    color_a = '#4F6C96'
+    color_b = '#EB6144'
+
+    # Generate the color scale using colorlover (copied, so the library's scale is left untouched)
+    n_colors = 11  # Number of colors in the scale
+    scale = list(cl.scales[str(n_colors)]['div']['RdBu'])
+
+    # Adjust the scale to start and end with the specified colors
+    start_color_index = (n_colors // 2) - 1
+    end_color_index = n_colors // 2
+
+    scale[start_color_index] = color_a
+    scale[end_color_index] = color_b
+    return scale
+
+
+def map_template():
+    import plotly.express as px
+
+    sample = pd.DataFrame({"country_name": ["Germany"], "location": ["DEU"], "rate": [0.0]})
+
+    # World Map: the outlines are fetched once by the browser, figures only reference them by URL
+    if geometry_codes is None:
+        outlines = dict(locations='country_name', locationmode='country names')
+    else:
+        outlines = dict(locations='location', geojson=app.get_asset_url(GEOMETRY_FILE.replace(os.sep, "/")))
+    map = px.choropleth(
+        data_frame=sample,
+        **outlines,
+        scope="world",
+        color='rate',
+        hover_name='country_name',
+        hover_data={'country_name': False, 'location': False},
+        labels={'rate': 'Fertility Rate'},
+    )
+
+    map.update_layout({"plot_bgcolor": "rgba(0, 0,0, 0.5)", "paper_bgcolor": "rgba(0, 0,0,0)"},
+                      transition_duration=500,
+                      margin=dict(l=2, r=2, b=2, t=2),
+                      )
+
+    # Remove Antarctica from default zoom
+    map.update_geos(lataxis_range=[-59, 90])
+
+    # map.layout.autosize
+    return map.to_dict()
+
+
+def ranking_template(marker_color=None):
+    import plotly.express as px
+
+    sample = pd.DataFrame({"country_name": ["Germany"], "rate": [0.0], "benchmark": [0.0]})
+
+    # Top 10 and Low 10 charts
+    fig = px.bar(data_frame=sample, x="rate", y="country_name", orientation='h', text_auto=True,
+                 hover_name='country_name',
+                 hover_data={'country_name': False},
+                 labels={'rate': 'Fertility Rate'},
+                 )
+
+    fig.update_layout(xaxis_title="fertility rate", yaxis_title=None,
+                      template="simple_white", yaxis=dict(autorange="reversed"),
+                      margin=dict(l=20, r=20, t=10, b=20))
+
+    fig.update_traces(textfont_size=12, textangle=0, textposition="outside", cliponaxis=False,
+                      marker_color='#D46351')
+
+    fig.add_traces(
+        go.Scatter(x=sample.benchmark, y=sample.country_name, mode='lines', name='mean',
+                   line=dict(color="black")))
+
+    if marker_color:
+        fig.update_traces(marker_color=marker_color)
+
+    # fig.layout.autosize
+    return fig.to_dict()
+
+
+def country_bar_template():
+    import plotly.express as px
+
+    sample = pd.DataFrame({"year": [2023], "rate": [0.0]})
+
+    # Bar chart (title and y range are filled in per country and age group)
+    figure = px.bar(sample, x='year', y='rate', hover_data=['rate', 'year'], color='rate')
+    figure.update_layout(height=150, xaxis_title="Year", yaxis_title=None, coloraxis_showscale=False,
+                         template="simple_white", yaxis_range=[0, 0],
+                         title={'text': "", 'font': {'size': 14}},
+                         margin=dict(l=80, r=0, b=0, t=30),
+                         )
+    return figure.to_dict()
+
+
+def indicator_template():
+    # Indicator
+    indicator = go.Figure(go.Indicator(
+        mode='number+delta',
+        value=0,
+        title={"text": "current fertility rate:", "font_color": 'black', 'font_size': 14},
+        delta={"reference": 0, 'relative': True, 'valueformat': '.1%'},
+        number={'font_color': 'black', 'font_size': 30}
+    ))
+
+    indicator.update_layout(height=150)
+    return indicator.to_dict()
+
+
+def comparison_template():
+    import plotly.express as px
+
+    sample = pd.DataFrame({"year": [2023], "rate": [0.0], "country_name": ["Germany"]})
+
+    figure = px.line(sample, x='year', y='rate', color='country_name', template="simple_white")
+
+    figure.update_traces(mode="markers+lines", hovertemplate=None)
+
+    figure.update_layout(height=400, xaxis_title="Year", yaxis_title="Fertility Rate",
+                         legend_title="Countries", hovermode="x unified")
+    return figure.to_dict()
+
+
+def deviation_template():
+    import plotly.express as px
+
+    sample = pd.DataFrame({"year": [2023], "deviation": [0]})
+
+    figure = px.bar(sample, x='year', y='deviation', color='deviation', color_discrete_sequence=diverging_scale(),
+                    range_color=(-100, 100))
+    figure.update_layout(height=300, xaxis_title="Year", yaxis_title='deviation from average',
+                         coloraxis_showscale=False, template="simple_white",
+                         margin=dict(l=80, r=0, b=0, t=30),
+                         )
+
+    figure.add_hline(y=0, line_width=3, line_dash="dash", line_color="black")
+    return figure.to_dict()
+
+
+class FigureTemplates(dict):
+    """The figure templates by name, each built by its builder function when it is first looked up."""
+
+    def __init__(self, builders):
+        super().__init__()
+        self.builders = builders
+        self.lock = threading.Lock()
+        self.themed = False
+
+    def __missing__(self, name):
+        with self.lock:
+            if name not in self:
+                if not self.themed:
+                    load_figure_template("spacelab")
+                    self.themed = True
+                self[name] = self.builders[name]()
+            return dict.__getitem__(self, name)
+
+
+templates = FigureTemplates({
+    "map": map_template,
+    "top": ranking_template,
+    "low": lambda: ranking_template(marker_color='#596A8E'),
+    "country_bar": country_bar_template,
+    "indicator": indicator_template,
+    "comparison": comparison_template,
+    "deviation": deviation_template,
+})
+
+
+def trace(template, index=0, **properties):
+    """Return trace ``index`` of a template with the given properties replaced."""
+    return {**template["data"][index], **properties}
+
+
+def fill(template, *traces, **layout):
+    """Return a figure with the layout of ``template``, the given traces and the given layout properties replaced.
+
+    The template layout is shared, not copied, so it must not be modified.
+    """
+    return {"data": list(traces), "layout": {**template["layout"], **layout} if layout else template["layout"]}
+
+
+def axis(template, name, title=None, range=None):
+    """Return axis ``name`` of a template layout with the given title text and range; without a range it autoscales."""
+    axis = {**template["layout"][name], "range": range} if range else template["layout"][name]
+    return {**axis, "title": {**axis["title"], "text": title}} if title else axis
 
 
 # ------------------------------CONNECTION OF PLOTLY GRAPHS WITH DASH COMPONENTS----------------------------------------
 
+def round_rates(rates):
+    """Return rates of the store as float64 for the charts, rounded to RATE_DECIMALS decimals.
+
+    Rounding is done in double precision, as float32 values would still print with their rounding error.
+    """
+    if RATE_DECIMALS < 0:
+        return chart_values(rates)
+    return np.round(np.asarray(rates, dtype=np.float64), RATE_DECIMALS)
+
+
 # Section with Slider, Age Buttons, World Map and container
+def overview_frame(year_selected, age_selected, countries=None):
+    """Return the countries with data for one year and age group, with the mean rate as benchmark.
+
+    ``countries`` restricts the frame to the given country positions, in that order.
+    """
+    store = current_store()
+    if countries is None:
+        countries, rates = store.year_slice(year_selected, age_selected)
+    else:
+        rates = store.rates[store.year_index[int(year_selected)], store.age_index[age_selected], countries]
+    dff = pd.DataFrame({"country_name": store.countries[countries], "location": current_dataset().locations[countries],
+                        "rate": round_rates(rates)})
+    dff["benchmark"] = round_rates(
+        store.mean_by_year_age[store.year_index[int(year_selected)], store.age_index[age_selected]])
+    return dff
+
+
+def overview_figures(year_selected, age_selected):
+    """Build the world map and the top 10 / low 10 charts for one year and age group."""
+    store = current_store()
+    source = current_dataset().source
+    # Data Preparation
+    dff = overview_frame(year_selected, age_selected)
+    mapped = dff[dff["location"] != ""]
+    countries = mapped["country_name"].to_numpy()
+
+    # World Map
+    map = fill(templates["map"], trace(templates["map"], locations=mapped["location"].to_numpy(),
+                                       z=mapped["rate"].to_numpy(), hovertext=countries,
+                                       customdata=countries[:, np.newaxis]))
+
+    # Top 10 and Low 10 charts
+    def ten_countries(template, dataframe):
+        countries = dataframe["country_name"].to_numpy()
+        return fill(template,
+                    trace(template, 0, x=dataframe["rate"].to_numpy(), y=countries, hovertext=countries),
+                    trace(template, 1, x=dataframe["benchmark"].to_numpy(), y=countries),
+                    xaxis=axis(template, "xaxis", source.rate_label.lower(), source.rate_range))
+
+    fig1 = ten_countries(templates["top"], overview_frame(
+        year_selected, age_selected, store.top_countries(year_selected, age_selected, RANKING_SIZE)))
+    fig2 = ten_countries(templates["low"], overview_frame(
+        year_selected, age_selected, store.bottom_countries(year_selected, age_selected, RANKING_SIZE)))
+
+    return map, fig1, fig2
+
+
+def cached_overview_figures(year_selected, age_selected):
+    """Return the serialized overview figures, from the figure store or built on a miss of both caches."""
+    current = current_dataset()
+    return figure_cache.get_or_build(
+        (current.version, int(year_selected), age_selected),
+        lambda: current.figures.get("overview", int(year_selected), age_selected)
+        or serialize_figures(overview_figures(year_selected, age_selected)))
+
+
+def overview_patches(year_selected, age_selected):
+    """Return partial updates that replace only the data arrays of the overview figures."""
+    store = current_store()
+    dff = overview_frame(year_selected, age_selected)
+    mapped = dff[dff["location"] != ""]
+    countries = mapped["country_name"].tolist()
+
+    map = Patch()
+    map["data"][0]["locations"] = mapped["location"].tolist()
+    map["data"][0]["hovertext"] = countries
+    map["data"][0]["customdata"] = [[country] for country in countries]
+    map["data"][0]["z"] = mapped["rate"].to_numpy()
+
+    def ten_countries(dataframe):
+        fig = Patch()
+        countries = dataframe["country_name"].tolist()
+        fig["data"][0]["x"] = dataframe["rate"].to_numpy()
+        fig["data"][0]["y"] = countries
+        fig["data"][0]["hovertext"] = countries
+        fig["data"][1]["x"] = dataframe["benchmark"].to_numpy()
+        fig["data"][1]["y"] = countries
+        return fig
+
+    top = store.top_countries(year_selected, age_selected, RANKING_SIZE)
+    bottom = store.bottom_countries(year_selected, age_selected, RANKING_SIZE)
+    return map, ten_countries(overview_frame(year_selected, age_selected, top)), \
+        ten_countries(overview_frame(year_selected, age_selected, bottom))
+
+
+def cached_overview_patches(year_selected, age_selected):
+    """Return the serialized patches that update the overview figures to one year and age group."""
+    current = current_dataset()
+    return patch_cache.get_or_build(
+        (current.version, int(year_selected), age_selected),
+        lambda: serialize_figures(overview_patches(year_selected, age_selected)))
+
+
 @app.callback(
     Output('container_1_text', 'children'),
     Output('container_1_value', 'children'),
@@ -315,195 +1619,299 @@ app.layout = html.Div([
     Output('world_map', 'figure'),
     Output('top10_barchart', 'figure'),
     Output('low10_barchart', 'figure'),
+    Output('year_slider', 'min'),
+    Output('year_slider', 'max'),
+    Output('year_slider', 'marks'),
     Input('year_slider', 'value'),
-    Input("age_buttons", "value")
+    Input("age_buttons", "value"),
+    State('year_slider', 'marks')
 )
-def update_graph(year_selected, age_selected):
+@timed("callback")
+def update_graph(year_selected, age_selected, marks=None):
+    store = current_store()
+    options = current_dataset().options
+    # the slider is only updated when the dataset has been reloaded with other years since the page was built
+    slider = (no_update,) * 3 if marks == options["year_marks"] else (*options["years"], options["year_marks"])
+    if int(year_selected) not in store.year_index:
+        return (no_update,) * 9 + slider
     # Data Preparation
-    dff = df.copy()
-    dfg = dff[dff["age"] == age_selected]
-    avg_rate_all_years = dfg["rate"].mean().astype(int)
-    dff = dff[dff["year"] == year_selected]
-    avg_rate_all_ages = dff["rate"].mean().astype(int)
-    dff = dff[dff["age"] == age_selected]
-    avg_rate = dff["rate"].mean().astype(int)
-    dff["benchmark"] = dff["rate"].mean()
+    with timed("prep"):
+        year_pos = store.year_index[int(year_selected)]
+        age_pos = store.age_index[age_selected]
+        avg_rate_all_years = store.mean_by_age[age_pos].astype(int)
+        avg_rate_all_ages = store.mean_by_year[year_pos].astype(int)
+        avg_rate = store.mean_by_year_age[year_pos, age_pos].astype(int)
+        # all age groups together, e.g. 15-44 from 15-19 to 40-44
+        all_ages = f"{store.ages[0].split('-')[0]}-{store.ages[-1].split('-')[-1]}"
+        source = current_dataset().source
 
     # Container
     container_1_text = html.Div(
-        ["out of 1000 women", html.Br(), html.B(" aged "), html.B(str(age_selected)), html.Br(), " gave birth in ",
+        [source.unit, html.Br(), html.B(" aged "), html.B(str(age_selected)), html.Br(), f" {source.event} in ",
          html.Br(), html.B(str(year_selected))]
     )
 
     container_1_value = str(avg_rate)
 
     container_2_text = html.Div(
-        ["out of 1000 women", html.Br(), html.B(" aged 15-44 "), html.Br(), " gave birth in ", html.Br(),
+        [source.unit, html.Br(), html.B(f" aged {all_ages} "), html.Br(), f" {source.event} in ", html.Br(),
          html.B(str(year_selected))])
 
     container_2_value = str(avg_rate_all_ages)
 
     container_3_text = html.Div(
-        ["out of 1000 women", html.Br(), html.B(" aged "), html.B(str(age_selected)), html.Br(), " gave birth ",
+        [source.unit, html.Br(), html.B(" aged "), html.B(str(age_selected)), html.Br(), f" {source.event} ",
          html.Br(), html.B("over all years")])
 
     container_3_value = str(avg_rate_all_years)
 
-    # World Map
-    map = px.choropleth(
-        data_frame=dff,
-        locations='country_name',
-        locationmode='country names',
-        scope="world",
-        color='rate',
-        hover_name='country_name',
-        hover_data={'country_name': False},
-        labels={'rate': 'Fertility Rate'},
-    )
-
-    map.update_layout({"plot_bgcolor": "rgba(0, 0,0, 0.5)", "paper_bgcolor": "rgba(0, 0,0,0)"},
-                      transition_duration=500,
-                      margin=dict(l=2, r=2, b=2, t=2),
-                      )
-
-    # Remove Antarctica from default zoom
-    map.update_geos(lataxis_range=[-59, 90])
-
-    # map.layout.autosize
-
-    # Top 10 and Low 10 charts
-    def ten_countries(dataframe):
-        fig = px.bar(data_frame=dataframe, x="rate", y="country_name", orientation='h', text_auto=True,
-                     hover_name='country_name',
-                     hover_data={'country_name': False},
-                     labels={'rate': 'Fertility Rate'},
-                     )
-
-        fig.update_layout(xaxis_title="fertility rate", yaxis_title=None,
-                          template="simple_white", yaxis=dict(autorange="reversed"), xaxis_range=[0, 350],
-                          margin=dict(l=20, r=20, t=10, b=20))
-
-        fig.update_traces(textfont_size=12, textangle=0, textposition="outside", cliponaxis=False,
-                          marker_color='#D46351')
+    # World Map, Top 10 and Low 10 charts: the first render sends full figures (as plain dicts, so Dash does not
+    # validate them again), later slider and button changes only patch the data arrays
+    if PATCH_UPDATES and ctx.triggered_id is not None:
+        map, fig1, fig2 = deserialize_figures(cached_overview_patches(year_selected, age_selected))
+    else:
+        map, fig1, fig2 = deserialize_figures(cached_overview_figures(year_selected, age_selected))
 
-        fig.add_traces(
-            go.Scatter(x=dataframe.benchmark, y=dataframe.country_name, mode='lines', name='mean',
-                       line=dict(color="black")))
+    return container_1_text, container_1_value, container_2_text, container_2_value, container_3_text, \
+        container_3_value, map, fig1, fig2, *slider
+
+
+# Year playback: all years of the selected age group are fetched in one payload and played back in the browser
+def playback_frames(age_selected):
+    """Return the world map and ranking data of every year for one age group as one columnar payload.
+
+    ``rates[y][c]`` is the rate of ``countries[c]`` in ``years[y]`` (null without data), drawn on the map at
+    ``locations[c]`` (empty without an outline); ``top[y]`` and ``low[y]`` are the country positions of the ranking
+    charts.
+    """
+    store = current_store()
+    age_pos = store.age_index[age_selected]
+    return {
+        "years": store.years,
+        "countries": store.countries,
+        "locations": current_dataset().locations,
+        "rates": round_rates(store.rates[:, age_pos, :]),
+        "means": round_rates(store.mean_by_year_age[:, age_pos]),
+        "top": [store.top_countries(year, age_selected, RANKING_SIZE) for year in store.years],
+        "low": [store.bottom_countries(year, age_selected, RANKING_SIZE) for year in store.years],
+    }
 
-        # fig.layout.autosize
-        return fig
 
-    fig1 = ten_countries(dff.nlargest(10, "rate"))
-    fig2 = ten_countries(dff.nsmallest(10, "rate")).update_traces(marker_color='#596A8E')
+@app.callback(
+    Output('playback_frames', 'data'),
+    Input('play_button', 'n_clicks'),
+    Input('age_buttons', 'value'),
+    prevent_initial_call=True
+)
+@timed("callback")
+def load_playback_frames(n_clicks, age_selected):
+    # frames are only needed while playing, i.e. after an odd number of clicks
+    if n_clicks % 2 == 0:
+        raise PreventUpdate
+    with timed("prep"):
+        return playback_frames(age_selected)
+
+
+app.clientside_callback(
+    """
+    function(n_clicks) {
+        const playing = n_clicks % 2 === 1;
+        return [!playing, 0, playing ? "Pause" : "Play"];
+    }
+    """,
+    Output('playback_interval', 'disabled'),
+    Output('playback_interval', 'n_intervals'),
+    Output('play_button', 'children'),
+    Input('play_button', 'n_clicks'),
+    prevent_initial_call=True
+)
 
-    return container_1_text, container_1_value, container_2_text, container_2_value, container_3_text, \
-        container_3_value, map, fig1, fig2
+app.clientside_callback(
+    """
+    function(n_intervals, frames, map, top, low) {
+        if (!frames || !map || !map.data || !top || !top.data || !low || !low.data) {
+            return window.dash_clientside.no_update;
+        }
+        const year = n_intervals % frames.years.length;
+        const rates = frames.rates[year];
+        const mean = frames.means[year];
+
+        const countries = [];
+        const locations = [];
+        const z = [];
+        rates.forEach(function(rate, i) {
+            if (rate !== null && frames.locations[i]) {
+                countries.push(frames.countries[i]);
+                locations.push(frames.locations[i]);
+                z.push(rate);
+            }
+        });
+        const newMap = Object.assign({}, map, {data: [Object.assign({}, map.data[0], {
+            locations: locations, z: z, hovertext: countries,
+            customdata: countries.map(function(country) { return [country]; })
+        })]});
+
+        function ranking(figure, positions) {
+            const names = positions.map(function(i) { return frames.countries[i]; });
+            return Object.assign({}, figure, {data: [
+                Object.assign({}, figure.data[0], {
+                    x: positions.map(function(i) { return rates[i]; }), y: names, hovertext: names
+                }),
+                Object.assign({}, figure.data[1], {x: names.map(function() { return mean; }), y: names})
+            ]});
+        }
+
+        return [newMap, ranking(top, frames.top[year]), ranking(low, frames.low[year]),
+                " Year " + frames.years[year]];
+    }
+    """,
+    Output('world_map', 'figure', allow_duplicate=True),
+    Output('top10_barchart', 'figure', allow_duplicate=True),
+    Output('low10_barchart', 'figure', allow_duplicate=True),
+    Output('playback_year', 'children'),
+    Input('playback_interval', 'n_intervals'),
+    State('playback_frames', 'data'),
+    State('world_map', 'figure'),
+    State('top10_barchart', 'figure'),
+    State('low10_barchart', 'figure'),
+    prevent_initial_call=True
+)
 
 
-# Dynamic Headline 2
+# Selected country, Dynamic Headline 2 and Multi Dropdown Menu for countries
+# (the click is resolved once here; the deep dive callbacks read the country from the 'selected_country' store)
 @app.callback(
+    Output('selected_country', 'data'),
     Output('info_country', 'children'),
     Output('headline_2', 'children'),
+    Output('dropdown_countries', 'value'),
     Input('world_map', 'clickData')
 )
-def update_graph(clickData):
-    # Get selected country from world map click data
+@timed("callback")
+def select_country(clickData):
+    store = current_store()
+    # Get selected country from world map click data (the map locations are codes, the names are in customdata)
     if clickData:
-        country_selected = clickData['points'][0]['location']
+        country_selected = clickData['points'][0]['customdata'][0]
+        dropdown_value = [country_selected]
     else:
-        country_selected = 'Germany'
+        country_selected = current_dataset().options["country"]
+        dropdown_value = country_selected
+
+    if country_selected not in store.country_index:
+        raise PreventUpdate
 
     container_info = "You have selected: " + str(country_selected)
     container_headline = "Deep Dive: " + str(country_selected)
 
-    return container_info, container_headline
+    return country_selected, container_info, container_headline, dropdown_value
 
 
 # Bar charts for each age group
+def country_figures(country_selected):
+    """Build the bar charts and indicators of every age group for one country, charts first."""
+    store = current_store()
+    panel_title = current_dataset().source.panel_title
+    # Data Preparation
+    max_rate = float(chart_values(store.max_by_country[store.country_index[country_selected]]))
+    bar, indicator = templates["country_bar"], templates["indicator"]
+    charts, indicators = [], []
+
+    # Loop to go through the first six age groups, one per panel
+    for age in store.ages[:6]:
+        years, rates = store.country_series(country_selected, age)
+        rounded = round_rates(rates)
+
+        # Bar chart
+        charts.append(fill(
+            bar, trace(bar, x=years, y=rounded, marker={**bar["data"][0]["marker"], "color": rounded}),
+            title={**bar["layout"]["title"], "text": panel_title.format(age=age)},
+            yaxis={**bar["layout"]["yaxis"], "range": [0, max_rate]}))
+
+        # Indicator
+        indicators.append(fill(indicator, trace(
+            indicator, value=int(rates[-1]), delta={**indicator["data"][0]["delta"], "reference": int(rates[0])})))
+
+    # datasets with fewer age groups leave the remaining panels empty
+    empty = [{}] * (6 - len(charts))
+    return charts + empty + indicators + empty
+
+
+def cached_country_figures(country_selected):
+    """Return the serialized deep-dive figures of one country, from the figure store or built on a miss of both."""
+    current = current_dataset()
+    return country_cache.get_or_build(
+        (current.version, country_selected),
+        lambda: current.figures.get("country", country_selected)
+        or serialize_figures(country_figures(country_selected)))
+
+
 @app.callback(
     Output('headline_rates_development', 'children'),
     [Output(f'bar_chart_{age}', 'figure') for age in ['19', '24', '29', '34', '39', '44']],
     [Output(f'indicator_{age}', 'figure') for age in ['19', '24', '29', '34', '39', '44']],
-    Input('world_map', 'clickData')
+    Input('selected_country', 'data')
 )
-def update_graph(clickdata):
-    # Get selected country from world map click data
-    if clickdata:
-        country_selected = clickdata['points'][0]['location']
-    else:
-        country_selected = 'Germany'
-
-    # Data Preparation
-    dff = df[df["country_name"] == country_selected]
-    max_rate = dff["rate"].max()
-    figures = []
-
+@timed("callback")
+def update_graph(country_selected):
     # Headline
-    container = "Development of Fertility Rates: " + str(country_selected)
+    container = f"Development of {current_dataset().source.rate_label}s: " + str(country_selected)
 
-    # Loop to go through all age groups
-    for age in ['15-19', '20-24', '25-29', '30-34', '35-39', '40-44']:
-        dff_age = dff[dff["age"] == age]
-        dff_min_year = dff_age[dff_age["year"] == dff_age["year"].min()]
-        dff_max_year = dff_age[dff_age["year"] == dff_age["year"].max()]
+    figures = deserialize_figures(cached_country_figures(country_selected))
 
-        # Bar chart
-        figure = px.bar(dff_age, x='year', y='rate', hover_data=['rate', 'year'], color='rate')
-        figure.update_layout(height=150, xaxis_title="Year", yaxis_title=None, coloraxis_showscale=False,
-                             template="simple_white", yaxis_range=[0, max_rate],
-                             title={'text': f"Fertility rate among women aged <b>{age}</b> years",
-                                    'font': {'size': 14}},
-                             margin=dict(l=80, r=0, b=0, t=30),
-                             )
-        figures.append(figure)
-
-        # Indicator
-        indicator = go.Figure(go.Indicator(
-            mode='number+delta',
-            value=int(dff_max_year['rate'].values),
-            title={"text": "current fertility rate:", "font_color": 'black', 'font_size': 14},
-            delta={"reference": int(dff_min_year['rate'].values), 'relative': True, 'valueformat': '.1%'},
-            number={'font_color': 'black', 'font_size': 30}
-        ))
-
-        indicator.update_layout(height=150)
-
-        figures.append(indicator)
-
-    return container, figures[0], figures[2], figures[4], figures[6], figures[8], figures[10], figures[1], figures[3], \
-        figures[5], figures[7], figures[9], figures[11]
-
-
-# Multi Dropdown Menu for countries
-@app.callback(Output('dropdown_countries', 'value'),
-              Input('world_map', 'clickData')
-              )
-def update_dropdown(click_data):
-    if click_data is not None:
-        selected_country = click_data['points'][0]['location']
-        return [selected_country]
-    else:
-        return 'Germany'
+    return container, *figures
 
 
 # Country Comparison
+def decimate(x, y, max_points):
+    """Downsample a line to at most ``max_points`` points, keeping the lowest and highest point of every bucket.
+
+    The first and last point are always kept, so are peaks; lines with at most ``max_points`` points (or
+    ``max_points`` below 4) are returned unchanged.
+    """
+    n = len(x)
+    if max_points < 4 or n <= max_points:
+        return x, y
+
+    # split the inner points into equally long buckets and sort each bucket by value
+    buckets = (max_points - 2) // 2
+    bucket = np.arange(n - 2) * buckets // (n - 2)
+    order = np.lexsort((y[1:-1], bucket)) + 1
+    starts = np.searchsorted(bucket, np.arange(buckets))
+    ends = np.append(starts[1:], n - 2) - 1
+    keep = np.unique(np.concatenate([[0, n - 1], order[starts], order[ends]]))
+    return x[keep], y[keep]
+
+
 @app.callback(
     Output('line_chart_country_comparison', 'figure'),
     Input('dropdown_age_1', 'value'),
     Input('dropdown_countries', 'value')
 )
+@timed("callback")
 def update_graph(age_selected, country_selected):
+    store = current_store()
     # Data Preparation
-    dff = df.copy()
-    dff = dff[dff["age"] == age_selected]
-    dff = dff.query('country_name==@country_selected').sort_values(by=["year", "country_name"])
-
-    figure = px.line(dff, x='year', y='rate', color='country_name', template="simple_white")
-
-    figure.update_traces(mode="markers+lines", hovertemplate=None)
-
-    figure.update_layout(height=400, xaxis_title="Year", yaxis_title="Fertility Rate",
-                         legend_title="Countries", hovermode="x unified")
+    with timed("prep"):
+        if isinstance(country_selected, str):
+            country_selected = [country_selected]
+        countries = [country for country in country_selected or [] if country in store.country_index]
+        # a cleared age dropdown draws an empty chart
+        series = [(country, *decimate(years, rates, COMPARISON_MAX_POINTS))
+                  for country, (years, rates) in zip(countries, store.countries_series(countries, age_selected))
+                  if len(years)] if age_selected in store.age_index else []
+        # countries in order of their first year of record, as plotly.express would draw them
+        series.sort(key=lambda item: (item[1][0], item[0]))
+
+    # many SVG lines make the browser slow, so larger comparisons are drawn with WebGL
+    line = templates["comparison"]
+    kind = "scattergl" if len(series) >= COMPARISON_WEBGL_THRESHOLD else line["data"][0]["type"]
+    colors = templates["comparison"]["layout"]["template"]["layout"]["colorway"]
+    figure = fill(line, *[trace(line, type=kind, name=country, legendgroup=country, x=years,
+                                y=round_rates(rates),
+                                line={**line["data"][0]["line"], "color": colors[i % len(colors)]})
+                          for i, (country, years, rates) in enumerate(series)],
+                  yaxis=axis(line, "yaxis", current_dataset().source.rate_label))
 
     return figure
 
@@ -514,53 +1922,448 @@ def update_graph(age_selected, country_selected):
     Output("bar_chart_deviation", 'figure'),
 
     Input('dropdown_age_2', 'value'),
-    Input('world_map', 'clickData')
+    Input('selected_country', 'data')
 )
-def update_graph(age_selected, clickdata):
+@timed("callback")
+def update_graph(age_selected, country_selected):
+    store = current_store()
     # Data Preparation
-    dff = df.copy()
-    dff = dff[dff["age"] == age_selected]
-    dff['mean'] = dff.groupby('year')['rate'].transform('mean')
-    dff['deviation'] = (dff['rate'] - dff['mean']).astype(int)
-
-    # Get selected country from world map click data
-    if clickdata:
-        country_selected = clickdata['points'][0]['location']
-    else:
-        country_selected = 'Germany'
-    dff = dff[dff["country_name"] == country_selected]
+    with timed("prep"):
+        # a cleared age dropdown draws an empty chart
+        if age_selected in store.age_index and country_selected in store.country_index:
+            years, deviations = store.country_deviations(country_selected, age_selected)
+            deviations = deviations.astype(int)
+        else:
+            years, deviations = np.array([], dtype=int), np.array([], dtype=int)
 
     # Headline
-    container = "Deviation from mean fertility rate: " + str(country_selected)
+    source = current_dataset().source
+    container = f"Deviation from mean {source.rate_label.lower()}: " + str(country_selected)
 
     # Bar chart
-    # Define the colors for the diverging scale
-    color_a = '#4F6C96'
-    color_b = '#EB6144'
+    bar = templates["deviation"]
+    figure = fill(bar, trace(bar, x=years, y=deviations, marker={**bar["data"][0]["marker"], "color": deviations}),
+                  yaxis=axis(bar, "yaxis", range=source.deviation_range))
 
-    # Generate the color scale using colorlover
-    n_colors = 11  # Number of colors in the scale
-    scale = cl.scales[str(n_colors)]['div']['RdBu']
+    return container, figure
 
-    # Adjust the scale to start and end with the specified colors
-    start_color_index = (n_colors // 2) - 1
-    end_color_index = n_colors // 2
 
-    scale[start_color_index] = color_a
-    scale[end_color_index] = color_b
+# -------------------------------------------------DATA EXPORT-----------------------------------------------------
+
+# /export.csv and /export.arrow return the rows behind the charts, filtered by the repeatable query parameters
+# ``year``, ``age`` and ``country`` (all of a kind where a parameter is missing):
+#
+#     /export.csv?year=2020&age=20-24                   world map and rankings
+#     /export.csv?country=France                        deep dive
+#     /export.csv?age=25-29&country=France&country=Kenya  comparison and deviation
+#     /export.csv?year=2020&age=20-24&band=90-100       top decile of the rankings, highest rate first
+#
+# The rows are read from the data store in chunks of at most EXPORT_CHUNK_CELLS (year, age, country) cells and
+# streamed, so every export runs in the same memory however many rows it returns.
+
+EXPORT_COLUMNS = ['country_code', 'country_name', 'year', 'age', 'rate', 'mean', 'deviation']
+EXPORT_CHUNK_CELLS = 8192
+
+
+def export_selection(store, args):
+    """Return the year, age and country positions selected by the query ``args``.
+
+    Years and ages are returned in the store's order, countries in the order they were given. ``band``, a range
+    of percentiles such as ``90-100``, selects the countries of one year and age group by their rank instead,
+    from the highest rate to the lowest. Raises KeyError naming the first unknown value or invalid parameter.
+    """
+    def positions(name, index, convert=str):
+        values = args.getlist(name)
+        if not values:
+            return np.arange(len(index))
+        selected = []
+        for value in dict.fromkeys(values):
+            try:
+                selected.append(index[convert(value)])
+            except (KeyError, ValueError):
+                raise KeyError(f"unknown {name} {value!r}") from None
+        return np.array(selected, dtype=np.intp)
+
+    years, ages = np.sort(positions("year", store.year_index, int)), np.sort(positions("age", store.age_index))
+    band = args.get("band")
+    if band is None:
+        return years, ages, positions("country", store.country_index)
+
+    if len(years) != 1 or len(ages) != 1 or "country" in args:
+        raise KeyError("band needs exactly one year and one age and selects the countries itself")
+    try:
+        lower, upper = (float(bound) for bound in band.split("-"))
+    except ValueError:
+        raise KeyError(f"invalid band {band!r}, use lower-upper percentiles such as 90-100") from None
+    if not 0 <= lower < upper <= 100:
+        raise KeyError(f"invalid band {band!r}, use lower-upper percentiles such as 90-100")
+    return years, ages, store.percentile_band(store.years[years[0]], store.ages[ages[0]], lower, upper)
+
+
+def export_chunks(store, years, ages, countries):
+    """Yield the selected rows with data as DataFrames of at most EXPORT_CHUNK_CELLS rows, by year, country and age."""
+    step = max(EXPORT_CHUNK_CELLS // len(ages), 1) if len(ages) else len(countries)
+    for y in years:
+        for start in range(0, len(countries), step):
+            block = countries[start:start + step]
+            rates = store.rates[y][np.ix_(ages, block)].T
+            c, a = np.nonzero(~np.isnan(rates))
+            if not len(c):
+                continue
+            yield pd.DataFrame({
+                "country_code": store.codes[block[c]],
+                "country_name": store.countries[block[c]],
+                "year": np.full(len(c), store.years[y]),
+                "age": store.ages[ages[a]],
+                "rate": rates[c, a],
+                "mean": store.mean_by_year_age[y, ages[a]].astype(np.float32),
+                "deviation": store.deviations[y][np.ix_(ages, block)].T[c, a],
+            }, columns=EXPORT_COLUMNS)
+
+
+def csv_stream(chunks):
+    yield ",".join(EXPORT_COLUMNS) + "\n"
+    for chunk in chunks:
+        yield chunk.to_csv(index=False, header=False)
+
+
+def arrow_stream(chunks):
+    """Return a generator of the chunks as an Arrow IPC stream, one record batch per chunk.
+
+    Raises ImportError if pyarrow is not installed.
+    """
+    import pyarrow as pa
+
+    schema = pa.schema([("country_code", pa.string()), ("country_name", pa.string()), ("year", pa.int16()),
+                        ("age", pa.string()), ("rate", pa.float32()), ("mean", pa.float32()),
+                        ("deviation", pa.float32())])
+
+    def generate():
+        sink = io.BytesIO()
+        with pa.ipc.new_stream(sink, schema) as writer:
+            for chunk in chunks:
+                writer.write_batch(pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False))
+                yield drain(sink)
+        yield drain(sink)
+
+    return generate()
+
+
+def drain(buffer):
+    """Return and remove the bytes written to a BytesIO so far."""
+    data = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return data
+
+
+def gzip_stream(stream):
+    """Compress a stream of str or bytes pieces into a gzip stream."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for piece in stream:
+        compressed = compressor.compress(piece.encode() if isinstance(piece, str) else piece)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+@server.route("/export.<format>")
+def export_data(format):
+    if request.args.get("dataset", DEFAULT_SOURCE) not in datasets.sources:
+        return {"error": f"unknown dataset '{request.args['dataset']}'"}, 400
+    # the store is resolved here, as the stream is generated after the request context has ended
+    store = current_store()
+    try:
+        years, ages, countries = export_selection(store, request.args)
+    except KeyError as error:
+        return {"error": error.args[0]}, 400
+
+    chunks = export_chunks(store, years, ages, countries)
+    if format == "csv":
+        stream, mimetype = csv_stream(chunks), "text/csv"
+    elif format == "arrow":
+        try:
+            stream, mimetype = arrow_stream(chunks), "application/vnd.apache.arrow.stream"
+        except ImportError:
+            return {"error": "Arrow export requires pyarrow"}, 501
+    else:
+        return {"error": f"unknown format {format}, use csv or arrow"}, 404
 
-    figure = px.bar(dff, x='year', y='deviation', color='deviation', color_discrete_sequence=scale,
-                    range_color=(-100, 100))
-    figure.update_layout(height=300, xaxis_title="Year", yaxis_title='deviation from average',
-                         coloraxis_showscale=False, template="simple_white", yaxis_range=[-300, 300],
-                         margin=dict(l=80, r=0, b=0, t=30),
-                         )
+    filename = f"{current_dataset().source.id}_rates.{format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        stream = gzip_stream(stream)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream, mimetype=mimetype, headers=headers)
 
-    figure.add_hline(y=0, line_width=3, line_dash="dash", line_color="black")
 
-    return container, figure
+# ---------------------------------------------RESPONSE COMPRESSION------------------------------------------------
+
+# Responses are compressed with the best content coding the client accepts: brotli if the optional brotli package
+# is installed, otherwise gzip. The responses of the overview and deep-dive callbacks, which carry the largest
+# figures, are kept after their first request with every encoding they were sent in; a repeated request (same
+# dataset version, same request body) is answered with the stored bytes, without running the callback or encoding
+# and compressing the response again.
+#
+# Flask runs before_request functions in order of registration and after_request functions in reverse order: the
+# callback timer starts before the response cache is looked up, so answers from the cache are timed as well; the
+# response cache stores a response before it is compressed, and the callback metrics, registered further down, see
+# it uncompressed.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+COMPRESSIBLE_TYPES = {"application/json", "application/javascript", "text/javascript", "text/html", "text/css",
+                      "text/plain"}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# callbacks whose responses are cached, by their first output
+CACHED_CALLBACKS = {"container_1_text", "headline_rates_development"}
 
 
+def compress(data, encoding):
+    """Return ``data`` compressed with the content coding ``encoding``, "br" or "gzip"."""
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, wbits=31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def accepted_encoding():
+    """Return the content coding the current response is compressed with, None if the client accepts none."""
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def encoded_body(entry, encoding):
+    """Return the body of a cached response in ``encoding`` (None for uncompressed), compressing it only once."""
+    if encoding not in entry:
+        entry[encoding] = compress(entry[None], encoding)
+    return entry[encoding]
+
+
+def callback_name():
+    """Return the first output of the callback the current request is for."""
+    return (request.get_json(silent=True) or {}).get("output", "").lstrip(".").split(".")[0]
+
+
+response_cache = FigureCache(RESPONSE_CACHE_SIZE)
+
+
+@server.after_request
+def compress_response(response):
+    if (COMPRESS_MIN_BYTES <= 0 or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESSIBLE_TYPES or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = accepted_encoding()
+    if encoding is None or len(response.get_data()) < COMPRESS_MIN_BYTES:
+        return response
+
+    if "response_entry" in g:
+        response.set_data(encoded_body(g.response_entry, encoding))
+    else:
+        response.set_data(compress(response.get_data(), encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+@server.before_request
+def start_callback_timer():
+    if CALLBACK_METRICS and request.path.endswith("/_dash-update-component"):
+        g.callback_start = time.perf_counter()
+        g.phases = {}
+
+
+@server.before_request
+def serve_cached_response():
+    """Answer a repeated overview or deep-dive callback request with its stored response."""
+    if (RESPONSE_CACHE_SIZE <= 0 or not request.path.endswith("/_dash-update-component")
+            or callback_name() not in CACHED_CALLBACKS):
+        return None
+    key = (current_dataset().version, hashlib.sha256(request.get_data()).hexdigest())
+    entry = response_cache.get(key)
+    if entry is None:
+        g.response_key = key
+        return None
+    # compress_response takes the compressed body from the entry as well
+    g.response_entry = entry
+    g.response_hit = True
+    return Response(entry[None], mimetype="application/json")
+
+
+@server.after_request
+def store_response(response):
+    if "response_key" in g and response.status_code == 200:
+        g.response_entry = {None: response.get_data()}
+        response_cache.put(g.response_key, g.response_entry)
+    return response
+
+
+# ----------------------------------------------SERVER ENDPOINTS---------------------------------------------------
+
+@server.route("/cache-stats")
+def cache_stats():
+    return {"overview": figure_cache.stats(), "patch": patch_cache.stats(), "country": country_cache.stats(),
+            "response": response_cache.stats(),
+            "precomputed": current_dataset().figures.stats(), "datasets": datasets.stats()}
+
+
+@server.route("/map-coverage")
+def map_coverage():
+    current = current_dataset()
+    unmatched = current.store.countries[current.locations == ""]
+    return {"geometry": GEOMETRY_FILE if geometry_codes is not None else None,
+            "countries": len(current.locations), "unmatched": unmatched.tolist()}
+
+
+@server.after_request
+def record_callback_metrics(response):
+    """Record the timings and response size of a callback request and report them in a Server-Timing header.
+
+    Build time is the time inside the callback minus its prep and serialize phases; everything outside of the
+    callback, which is dominated by Dash encoding the response, counts as serialize. Requests answered from the
+    response cache skip the callback and are timed as a single ``cache`` phase.
+    """
+    if "phases" not in g:
+        return response
+    total = time.perf_counter() - g.callback_start
+    if "response_hit" in g:
+        phases = {"cache": total}
+    else:
+        inside = g.phases.get("callback", total)
+        prep = g.phases.get("prep", 0.0)
+        serialize = g.phases.get("serialize", 0.0)
+        phases = {"prep": prep, "build": max(inside - prep - serialize, 0.0),
+                  "serialize": serialize + max(total - inside, 0.0)}
+
+    body = response.get_data() if response.status_code == 200 else b""
+    output_bytes = None
+    if body and callback_metrics.sample_payload():
+        output_bytes = {f"{component}.{prop}": len(json.dumps(value, separators=(",", ":")))
+                        for component, props in json.loads(body).get("response", {}).items()
+                        for prop, value in props.items()}
+
+    callback_metrics.observe(callback_name(), total, phases, len(body), output_bytes)
+    response.headers["Server-Timing"] = ", ".join(
+        [f"{phase};desc=hit;dur={seconds * 1000:.1f}" if phase == "cache" else f"{phase};dur={seconds * 1000:.1f}"
+         for phase, seconds in phases.items()] + [f"total;dur={total * 1000:.1f}"])
+    return response
+
+
+@server.route("/metrics")
+def metrics():
+    return Response(callback_metrics.render({"overview": figure_cache, "patch": patch_cache, "country": country_cache,
+                                             "response": response_cache}),
+                    mimetype="text/plain; version=0.0.4")
+
+
+def overview_views(store):
+    """Return every (year, age) combination the year slider and the age selectors can select."""
+    marked = set(slider_years(store.years))
+    years = [int(year) for year in store.years if year in marked or year == store.years.max()]
+    return [(year, str(age)) for year in years for age in store.ages]
+
+
+def warm_figure_cache():
+    """Render the overview figures, and the patches updating them, for every (year, age) the slider can select."""
+    for year, age in overview_views(current_store()):
+        cached_overview_figures(year, age)
+        if PATCH_UPDATES:
+            cached_overview_patches(year, age)
+
+
+def warm_country_cache(countries):
+    """Render the deep-dive figures of the given countries into the country cache."""
+    store = current_store()
+    for country in countries:
+        if country in store.country_index:
+            cached_country_figures(country)
+
+
+def warm_caches():
+    if FIGURE_CACHE_WARMUP:
+        warm_figure_cache()
+    if COUNTRY_CACHE_WARMUP:
+        warm_country_cache(COUNTRY_CACHE_WARMUP)
+
+
+def render_views(source_id, version, views):
+    """Render the serialized figures of ``views``, ("overview", year, age) or ("country", country) tuples.
+
+    Runs in a worker process of ``precompute_figures``. Returns the (store key, figures) pairs; views that fail to
+    render are left out and rendered live when requested.
+    """
+    renderers = {"overview": overview_figures, "country": country_figures}
+    rendered = []
+    with server.test_request_context(f"/?dataset={source_id}"):
+        if current_dataset().version != version:
+            raise RuntimeError(f"dataset {source_id} changed while its figures were rendered")
+        for kind, *inputs in views:
+            try:
+                rendered.append((FigureStore.key(kind, *inputs), serialize_figures(renderers[kind](*inputs))))
+            except Exception:
+                server.logger.exception("Rendering %s %s of %s failed", kind, inputs, source_id)
+    return rendered
+
+
+def precompute_figures(source, jobs):
+    """Render every overview and deep-dive view of a data source with ``jobs`` processes into its figure store.
+
+    Returns the number of views stored and the size of the pack in bytes.
+    """
+    current = datasets.get(source.id)
+    views = [("overview", *view) for view in overview_views(current.store)]
+    views += [("country", str(country)) for country in current.store.countries]
+    size = -(-len(views) // (jobs * 4))
+    chunks = [views[i:i + size] for i in range(0, len(views), size)]
+
+    # spawned workers import this module afresh; they need neither the cache warmup nor the reload thread
+    os.environ.update(FIGURE_CACHE_WARMUP="0", COUNTRY_CACHE_WARMUP="", DATA_RELOAD_INTERVAL="0")
+    with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+        rendered = pool.map(render_views, [source.id] * len(chunks), [current.version] * len(chunks), chunks)
+        return write_figure_store(source, current.version, itertools.chain.from_iterable(rendered))
+
+
+startup.mark("callbacks")
+
+# the caches are filled in the background, so the server can take requests right away
+if FIGURE_CACHE_WARMUP or COUNTRY_CACHE_WARMUP:
+    threading.Thread(target=warm_caches, daemon=True, name="cache-warmup").start()
+if DATA_RELOAD_INTERVAL > 0:
+    threading.Thread(target=watch_datasets, args=(DATA_RELOAD_INTERVAL,), daemon=True, name="dataset-watcher").start()
+
 # ------------------------------------------------------------------------------
 if __name__ == "__main__":
-    app.run_server(debug=True)
+    parser = argparse.ArgumentParser(description="Interactive dashboard exploring global fertility rates")
+    parser.add_argument("--ingest", action="store_true",
+                        help="rebuild the preprocessed dataset caches of all data sources from their CSVs and exit")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print the time spent in each startup phase, including the deferred ones, and exit")
+    parser.add_argument("--precompute", action="store_true",
+                        help="render the figures of every overview and deep-dive view into the dataset caches and exit")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="worker processes of --precompute (default: number of CPUs)")
+    args = parser.parse_args()
+
+    if args.ingest:
+        for source in datasets.sources.values():
+            write_dataset_cache(prepare_dataset(source), source.cache_dir, source.path)
+    elif args.precompute:
+        for source in datasets.sources.values():
+            start = time.perf_counter()
+            views, nbytes = precompute_figures(source, args.jobs)
+            print(f"{source.id}: {views} views, {nbytes / 2 ** 20:.1f} MB in {time.perf_counter() - start:.1f} s")
+    elif args.profile_startup:
+        startup.mark("background threads")
+        for name in templates.builders:
+            templates[name]
+        startup.mark("figure templates (first callback)")
+        serve_layout()
+        startup.mark("layout (first page load)")
+        print(startup.report())
+    else:
+        app.run_server(debug=True)